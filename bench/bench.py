@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+""" Load test of the bot menu against a local fake Bot API server and a generated dataset
+    Creates a scratch schema like `sql/plancheck.py` does; then simulated users go through
+    start -> announce -> more -> book -> confirm -> result -> showticket, their updates are processed
+    by the bot dispatcher with the real handlers and connector.
+    Reports latency of handlers and connector methods (p50/p99), updates per second,
+    database queries and Bot API requests per update.
+    Use a throwaway database: the scratch schema is dropped afterwards unless `--keep` is set.
+    Database password is taken from PGPASSWORD environment variable.
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import pathlib
+import argparse
+import itertools
+import psycopg2
+from queue import Queue
+
+BENCH_DIR = pathlib.Path(__file__).absolute().parent
+sys.path[1:1] = [(BENCH_DIR.parent / 'bot').as_posix(), (BENCH_DIR.parent / 'sql').as_posix()]
+
+from telegram import Update
+from telegram.ext import JobQueue
+from telegram.utils.request import Request
+from migrate import migrate, render
+from plancheck import SQL_DIR, load_schema
+from metrics import InstrumentedBot, handler_seconds, handler_errors, db_method_seconds, update_seconds, update_queries, telegram_seconds
+from bot_connector import BotConnector
+from menu import MenuHandler
+from states import CallbackData, DialogMessages
+from dispatch import ShardedDispatcher
+from handlers import setup_handlers
+from persistence import SQLitePersistence
+from iopool import IO_WORKERS
+from tickets import TicketSigner
+from fakeapi import FakeBotAPI, BOT_USER
+
+
+SETTINGS = {
+    'SERVICE_INTERVAL': '7 day',
+    'ACTUAL_INTERVAL': '1 hour',
+    'TIMEZONE': 'Europe/Moscow',
+    'MAXBOOK': '3',
+    'BOT_ADMIN_ID': '100000001',
+    'RELATED_CHANNEL': 'https://t.me/bench',
+}
+_update_ids = itertools.count(1)
+
+
+def user_updates(bot, client_id, activity_id):
+    """ Updates of one simulated user: start -> announce -> more -> book -> confirm -> result -> showticket """
+    user = {'id': client_id, 'is_bot': False, 'first_name': 'First', 'username': f'client_{client_id}'}
+    chat = {'id': client_id, 'type': 'private'}
+    update_id = next(_update_ids)
+    yield Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': user,
+        'text': '/start', 'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}}, bot)
+    for data in (CallbackData.ANNOUNCE,
+                 f'{CallbackData.MORE}:{activity_id}',
+                 f'{CallbackData.BOOK}:{activity_id}',
+                 f'{CallbackData.BOOK_CONFIRM}:1',
+                 CallbackData.BOOK_ACCEPT,
+                 f'{CallbackData.SHOWTICKET}:{activity_id}'):
+        update_id = next(_update_ids)
+        yield Update.de_json({'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': user, 'chat_instance': str(client_id), 'data': data,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'chat': chat, 'from': BOT_USER, 'text': ''}}}, bot)
+
+
+def run(dispatcher, flows, timeout):
+    """ Push updates of all users step by step and wait for processing; return elapsed seconds """
+    total = sum(len(updates) for updates in flows)
+    start = time.perf_counter()
+    for step in itertools.zip_longest(*flows):
+        for update in step:
+            if update is not None:
+                dispatcher.process_update(update)
+    while (done := update_seconds.count()) < total:
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f'{done} of {total} updates processed in {timeout} seconds')
+        time.sleep(0.05)
+    return time.perf_counter() - start
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+def latency_report(histogram, label):
+    """ {label value: {count, p50, p99}} in milliseconds """
+    return {dict(key)[label]: {'count': len(values),
+                               'p50': round(quantile(values, 0.5) * 1000, 2),
+                               'p99': round(quantile(values, 0.99) * 1000, 2)}
+            for key, values in sorted(histogram.samples().items())}
+
+
+def report(elapsed):
+    updates = [value for values in update_seconds.samples().values() for value in values]
+    queries = [value for values in update_queries.samples().values() for value in values]
+    requests = sum(len(values) for values in telegram_seconds.samples().values())
+    return {
+        'updates': len(updates),
+        'seconds': round(elapsed, 2),
+        'updates_per_second': round(len(updates) / elapsed, 1),
+        'update_p50': round(quantile(updates, 0.5) * 1000, 2),
+        'update_p99': round(quantile(updates, 0.99) * 1000, 2),
+        'queries_per_update': round(sum(queries) / len(queries), 2),
+        'queries_per_update_p99': quantile(queries, 0.99),
+        'api_requests_per_update': round(requests / len(updates), 2),
+        'handler_errors': handler_errors.total(),
+        'handlers': latency_report(handler_seconds, 'handler'),
+        'db_methods': latency_report(db_method_seconds, 'method'),
+    }
+
+
+def print_report(result):
+    for title, section in (('handler', 'handlers'), ('connector method', 'db_methods')):
+        print(f'{title:<32}{"count":>8}{"p50 ms":>10}{"p99 ms":>10}')
+        for name, row in result[section].items():
+            print(f'{name:<32}{row["count"]:>8}{row["p50"]:>10}{row["p99"]:>10}')
+        print()
+    print(f'updates: {result["updates"]} in {result["seconds"]} s, {result["updates_per_second"]} updates/s',
+          f'update latency: p50 {result["update_p50"]} ms, p99 {result["update_p99"]} ms',
+          f'db queries per update: {result["queries_per_update"]} (p99 {result["queries_per_update_p99"]})',
+          f'bot api requests per update: {result["api_requests_per_update"]}',
+          f'handler errors: {result["handler_errors"]}', sep='\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=5432)
+    parser.add_argument('--dbname', required=True, help='throwaway database')
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--schema', default='bench', help='scratch schema name')
+    parser.add_argument('--keep', action='store_true', help='do not drop scratch schema')
+    parser.add_argument('--places', type=int, default=50)
+    parser.add_argument('--activities', type=int, default=20000)
+    parser.add_argument('--future', type=int, default=20, help='number of announced activities')
+    parser.add_argument('--clients', type=int, default=50000)
+    parser.add_argument('--visitors', type=int, default=30, help='max bookings per activity')
+    parser.add_argument('--users', type=int, default=2000, help='number of simulated users')
+    parser.add_argument('--shards', type=int, default=4, help='dispatcher worker threads')
+    parser.add_argument('--pool-size', type=int, help='database connections (sized for all bot threads by default)')
+    parser.add_argument('--latency', type=float, default=0, help='fake Bot API response delay (in seconds)')
+    parser.add_argument('--persistence', help='session storage file (none by default)')
+    parser.add_argument('--timeout', type=float, default=600, help='max run duration (in seconds)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='save report to file for comparison')
+    args = parser.parse_args()
+    if args.users > args.clients:
+        parser.error('number of users exceeds number of clients')
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+
+    conn = psycopg2.connect(dbname=args.dbname, user=args.user, host=args.host, port=args.port)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f'DROP SCHEMA IF EXISTS {args.schema} CASCADE')
+    try:
+        print(f'create scratch schema `{args.schema}`')
+        load_schema(cursor, args.schema)
+        migrate(conn, args.schema, env={'PSQL_USER': args.user, 'PSQL_HANDLER_USER': args.user})
+        print('generate dataset')
+        cursor.execute(render(SQL_DIR / 'dataset.sqltemplate', {
+            'SCHEMA': args.schema, 'PLACES': str(args.places), 'ACTIVITIES': str(args.activities),
+            'FUTURE_ACTIVITIES': str(args.future), 'CLIENTS': str(args.clients), 'VISITORS': str(args.visitors),
+        }))
+        cursor.executemany(f'INSERT INTO {args.schema}.settings VALUES (%s, %s)', list(SETTINGS.items()))
+        cursor.execute(f'''SELECT array_agg(activity_id) FROM {args.schema}.activity
+                           WHERE active AND openreg <= NOW() AND showtime > NOW()''')
+        activities = cursor.fetchone()[0]
+
+        # bot with fake Telegram and scratch database
+        api = FakeBotAPI(latency=args.latency).start()
+        bot = InstrumentedBot('100:bench', base_url=api.base_url, request=Request(con_pool_size=args.shards + IO_WORKERS + 8 + 2))
+        connector = BotConnector(dbname=args.dbname, username=args.user, schema=args.schema, host=args.host, port=args.port,
+                                 pool_size=args.pool_size or args.shards + IO_WORKERS + 8 + 2, password=os.environ.get('PGPASSWORD', ''))
+        menu = MenuHandler(DialogMessages(BENCH_DIR.parent / 'bot' / 'dialogs.cnf'), connector, signer=TicketSigner(b'bench'))
+        persistence = SQLitePersistence(args.persistence) if args.persistence else None
+        job_queue = JobQueue()
+        dispatcher = ShardedDispatcher(bot, Queue(), job_queue=job_queue, shards=args.shards, persistence=persistence)
+        job_queue.set_dispatcher(dispatcher)
+        setup_handlers(dispatcher, menu)
+        job_queue.start()
+
+        rnd = random.Random(args.seed)
+        flows = [list(user_updates(bot, 100000000 + client, rnd.choice(activities)))
+                 for client in rnd.sample(range(1, args.clients + 1), args.users)]
+        for histogram in (handler_seconds, db_method_seconds, update_seconds, update_queries, telegram_seconds):
+            histogram.record()
+        print(f'run {args.users} users, {sum(map(len, flows))} updates')
+        try:
+            result = report(run(dispatcher, flows, args.timeout))
+        finally:
+            dispatcher.stop()
+            job_queue.stop()
+            if persistence is not None:
+                persistence.flush()
+            connector.close()
+            api.shutdown()
+        print()
+        print_report(result)
+        if args.json:
+            pathlib.Path(args.json).write_text(json.dumps(result, indent=2))
+    finally:
+        if not args.keep:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {args.schema} CASCADE')
+        conn.close()
@@ -0,0 +1,76 @@
+""" Local stand-in of Telegram Bot API for benchmarks
+    Answers every method instantly (or after `latency` seconds) with a minimal valid result:
+    sent and edited messages get new message ids, other methods return `true`.
+"""
+import re
+import json
+import time
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+BOT_USER = {'id': 100, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup', 'sendPhoto', 'sendDocument'}
+CHAT_ID = re.compile(rb'name="chat_id"\r\n\r\n(-?\d+)')
+
+
+class BotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # keep-alive: bot connection pool is reused as with real API
+    disable_nagle_algorithm = True
+    wbufsize = -1                       # headers and body in one packet
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        result = self.server.result(method, self.__parameters(body))
+        payload = json.dumps({'ok': True, 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def __parameters(self, body):
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(body or b'{}')
+        # multipart upload (photos): only the chat is needed
+        return {'chat_id': int(m.group(1))} if (m := CHAT_ID.search(body)) else {}
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """ Fake Bot API server: pass `base_url` to `telegram.Bot` """
+    daemon_threads = True
+
+    def __init__(self, addr=('127.0.0.1', 0), *, latency=0):
+        super().__init__(addr, BotAPIHandler)
+        self.latency = latency
+        self.__message_ids = itertools.count(1)
+        self.__lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/bot'
+
+    def result(self, method, parameters):
+        if method == 'getMe':
+            return BOT_USER
+        if method not in MESSAGE_METHODS:
+            return True
+        with self.__lock:
+            message_id = parameters.get('message_id') or next(self.__message_ids)
+        chat_id = int(parameters.get('chat_id') or 0)
+        message = {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                   'chat': {'id': chat_id, 'type': 'private'}, 'text': parameters.get('text', '')}
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': f'photo{message_id}', 'file_unique_id': f'photo{message_id}', 'width': 290, 'height': 290}]
+        return message
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='fake-bot-api', daemon=True).start()
+        return self
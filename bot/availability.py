@@ -0,0 +1,109 @@
+import time
+import threading
+from collections import Counter
+
+
+class ActivityStats:
+    """ Booking state of activity: booked places per visitor and redeemed tickets """
+    __slots__ = ('visitors', 'redeemed', 'booked', 'version', 'loaded')
+
+    def __init__(self, visitors=None, redeemed=None):
+        self.visitors = dict(visitors or {})     # client_id -> booked places
+        self.redeemed = set(redeemed or ())      # client_id of redeemed tickets
+        self.booked = sum(self.visitors.values())
+        self.version = 0
+        self.loaded = time.monotonic()
+
+    def set_quantity(self, client_id, quantity):
+        """ Apply visitor booking change """
+        old = self.visitors.pop(client_id, 0)
+        self.redeemed.discard(client_id)        # booking change resets ticket
+        if quantity > 0:
+            self.visitors[client_id] = quantity
+        self.booked += quantity - old
+        self.version += 1
+
+
+class AvailabilityCache:
+    """ In-process activities booking state
+        Entries are loaded on demand and then maintained incrementally with `update`;
+        they are reloaded from database after `ttl` seconds to pick up changes made outside the bot.
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.__stats = {}
+        # changes are numbered; loads don't store stats of activities changed after they started
+        self.__seq = 0
+        self.__writes = {}          # activity_id -> number of the last change, kept only while older loads run
+        self.__dropped = 0          # number of the last whole cache invalidation
+        self.__loads = Counter()    # running loads by number of the last change before start
+        self.__lock = threading.Lock()
+
+    def get(self, activity_ids, loader):
+        """ Get stats for activities
+            `loader` gets missing ids and returns {activity_id: ({client_id: quantity}, {redeemed client_id})}
+        """
+        now = time.monotonic()
+        with self.__lock:
+            stats = {aid: st for aid in activity_ids if (st := self.__stats.get(aid)) and (now - st.loaded < self.ttl)}
+            missing = [aid for aid in activity_ids if aid not in stats]
+            if not missing:
+                return stats
+            start = self.__seq
+            self.__loads[start] += 1
+        try:
+            loaded = loader(missing)
+        except BaseException:
+            with self.__lock:
+                self.__finish(start)
+            raise
+        with self.__lock:
+            for aid in missing:
+                st = ActivityStats(*loaded.get(aid, ()))
+                if (old := self.__stats.get(aid)) is not None:
+                    st.version = old.version + 1
+                if max(self.__writes.get(aid, 0), self.__dropped) <= start:      # no changes were applied while loading
+                    self.__stats[aid] = st
+                stats[aid] = st
+            self.__finish(start)
+        return stats
+
+    def __finish(self, start):
+        """ Unregister finished load and forget changes no running load started before """
+        self.__loads[start] -= 1
+        if not self.__loads[start]:
+            del self.__loads[start]
+        oldest = min(self.__loads, default=self.__seq)
+        self.__writes = {aid: seq for aid, seq in self.__writes.items() if seq > oldest}
+
+    def __changed(self, activity_id):
+        self.__seq += 1
+        if self.__loads:        # running loads may miss the change
+            self.__writes[activity_id] = self.__seq
+
+    def update(self, activity_id, client_id, quantity):
+        """ Apply booking change made by bot """
+        activity_id, client_id, quantity = int(activity_id), int(client_id), int(quantity)
+        with self.__lock:
+            self.__changed(activity_id)
+            if (st := self.__stats.get(activity_id)) is not None:
+                st.set_quantity(client_id, quantity)
+
+    def redeem(self, activity_id, client_id):
+        """ Mark ticket as redeemed """
+        with self.__lock:
+            self.__changed(int(activity_id))
+            if (st := self.__stats.get(int(activity_id))) is not None:
+                st.redeemed.add(int(client_id))
+                st.version += 1
+
+    def drop(self, activity_id=None):
+        """ Invalidate activity stats or the whole cache """
+        with self.__lock:
+            if activity_id is None:
+                self.__stats.clear()
+                self.__seq += 1
+                self.__dropped = self.__seq
+            else:
+                self.__stats.pop(int(activity_id), None)
+                self.__changed(int(activity_id))
@@ -1,88 +1,149 @@
+import time
+STARTED = time.perf_counter()       # startup phases are timed from here: imports take a noticeable share
+import random
 import logging
 import pathlib
 import configparser
 import keyring
+from queue import Queue
 
-from telegram.ext import Updater, ConversationHandler, MessageHandler, CallbackQueryHandler, CommandHandler
-from telegram.ext.filters import Filters
+from telegram.utils.request import Request
+from telegram.ext import Updater, JobQueue
 
-from menu import MenuHandler
-from states import ErrorState, CallbackData, ConversationState, DialogMessages
+from menu import MenuHandler, SETTINGS_WAIT
+from states import DialogMessages, warm_up_morph
 from bot_connector import BotConnector
+from dispatch import ShardedDispatcher
+from handlers import setup_handlers
+from persistence import SQLitePersistence
+from iopool import IO_WORKERS
+from broadcast import Broadcaster
+from tickets import TicketCache, TicketSigner
+from render import RenderCache
+from metrics import InstrumentedBot, start_http_server, startup
 from functools import partial
 
 
-# TODO logging: replace print with log
-# # init logger
-# logging.basicConfig(
-#     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-#     level=logging.INFO
-# )
+class SampleFilter(logging.Filter):
+    """ Pass only a share of records below `level` (per-update debug output) """
+    def __init__(self, rate, level=logging.INFO):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+
+    def filter(self, record):
+        return record.levelno >= self.level or random.random() < self.rate
 
 
 # read configuration
 CONFIG_FILE = pathlib.Path('my.cnf').absolute()
 config = configparser.ConfigParser()
 config.read(CONFIG_FILE.as_posix())
+# init logger
+log_handler = logging.StreamHandler()
+log_handler.addFilter(SampleFilter(config['BOT'].getfloat('log_sample', 1.0)))
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=config['BOT'].get('log_level', 'INFO').upper(),
+    handlers=[log_handler]
+)
+log = logging.getLogger(__name__)
+startup.started = STARTED
+startup.mark('imports')
+# lazy start: settings and morphological dictionaries are loaded in background, updates are served at once
+lazy_start = config['BOT'].getboolean('lazy_start', True)
+warm_up_morph(background=lazy_start)
+# threads calling database: update handlers, their I/O helpers, notification senders, job queue and settings loader;
+# connections are opened on demand, so the pool is sized for all of them by default
+shards = config['BOT'].getint('shards', 4)
+broadcast_workers = config['BOT'].getint('broadcast_workers', 8)
 # init connector
 connector = BotConnector(dbname=config['DATABASE']['name'],
                          username=config['DATABASE']['user'],
                          schema=config['DATABASE']['schema'],
                          host=config['DATABASE']['host'],
-                         port=config['DATABASE']['port'])
+                         port=config['DATABASE']['port'],
+                         pool_size=config['DATABASE'].getint('pool_size', shards + IO_WORKERS + broadcast_workers + 2),
+                         idle_timeout=config['DATABASE'].getint('idle_timeout', 300),
+                         max_lifetime=config['DATABASE'].getint('max_lifetime', 3600),
+                         profile_size=config.getint('CACHE', 'profile_size', fallback=1024),
+                         profile_ttl=config.getint('CACHE', 'profile_ttl', fallback=600),
+                         availability_ttl=config.getint('CACHE', 'availability_ttl', fallback=300),
+                         activity_ttl=config.getint('CACHE', 'activity_ttl', fallback=60),
+                         events_ttl=config.getint('CACHE', 'events_ttl', fallback=10),
+                         lazy_settings=lazy_start)
 # read dialogs configuration
-text = DialogMessages('dialogs.cnf')
-menu = MenuHandler(text, connector)
+text = DialogMessages('dialogs.cnf', watch=config['BOT'].getint('dialogs_watch', 10))
+menu = MenuHandler(text, connector, Broadcaster(rate=config['BOT'].getint('broadcast_rate', 25),
+                                                  workers=broadcast_workers),
+                   TicketCache(max_bytes=config.getint('CACHE', 'tickets_size', fallback=16) * 2 ** 20),
+                   # tickets signing key: dedicated one or derived from bot token
+                   TicketSigner(key) if (key := keyring.get_password('telegram', 'ticketkey')) else
+                   TicketSigner.from_token(keyring.get_password('telegram', 'botuser')),
+                   RenderCache(maxsize=config.getint('CACHE', 'render_size', fallback=4096)),
+                   page_size=config['BOT'].getint('page_size', 5),
+                   reports=config['BOT'].get('reports', 'reports'))
+startup.mark('init')
 
 
-def debugger(update, context):
-    """ For manual testing new features or development """
-    print('DEBUGGER CALLBACK')
+def activity_changed(payload, job_queue):
+    """ Activity change notification handler """
+    connector.drop_activity_cache(payload)
+    menu.reschedule_notifier(job_queue, int(payload))
 
 
-if __name__ == '__main__':
-    # init bot updater
-    updater = Updater(token=keyring.get_password('telegram', 'botuser'))
-    dispatcher = updater.dispatcher
-    # init handlers
-    conversation_handler = ConversationHandler(
-        entry_points=[
-            CommandHandler('start', menu.start),
-            MessageHandler(Filters.text, menu.start)
-        ],
-        states={    # conversation states dictionary
-            ConversationState.FIRST_MET: [
-                MessageHandler(Filters.text, menu.first_met)
-            ],
+def first_refresh(context):
+    """ Full notifiers refresh: notifiers are scheduled in settings time zone, so it is retried until settings are loaded """
+    if connector.wait_settings(SETTINGS_WAIT):
+        menu.refresh_notifiers(context)
+    else:
+        log.warning('Settings are not loaded in %s seconds: notifiers refresh is postponed', SETTINGS_WAIT)
+        context.job_queue.run_once(first_refresh, SETTINGS_WAIT)
 
-            ConversationState.MENU: [
-                CallbackQueryHandler(debugger, pattern='DEBUG'),
-                CallbackQueryHandler(menu.main, pattern=rf'^{CallbackData.MAIN}'),
-                CallbackQueryHandler(menu.available_activities, pattern=rf'^{CallbackData.ANNOUNCE}|{CallbackData.MYBOOKING}'),
-                CallbackQueryHandler(menu.service_activities, pattern=rf'^{CallbackData.SERVICE}'),
-                CallbackQueryHandler(menu.activity_info, pattern=rf'^{CallbackData.MORE}'),
-                CallbackQueryHandler(menu.showmap, pattern=rf'^{CallbackData.SHOWMAP}'),
-                CallbackQueryHandler(menu.showticket, pattern=rf'^{CallbackData.SHOWTICKET}'),
-                CallbackQueryHandler(menu.book, pattern=rf'^{CallbackData.BOOK}'),
-                CallbackQueryHandler(menu.book_confirm, pattern=rf'^{CallbackData.BOOK_CONFIRM}'),
-                CallbackQueryHandler(menu.book_result, pattern=rf'^{CallbackData.BOOK_ACCEPT}'),
-                CallbackQueryHandler(partial(menu.direct_switch, target=CallbackData.GOODBYE), pattern=rf'^{CallbackData.GOODBYE}'),
-                MessageHandler(Filters.text, menu.message)
-            ],
 
-            ConversationHandler.TIMEOUT: [
-                MessageHandler(Filters.all, partial(menu.direct_switch, target=CallbackData.ERROR, errstate=ErrorState.TIMEOUT)),
-                CallbackQueryHandler(partial(menu.direct_switch, target=CallbackData.ERROR, errstate=ErrorState.TIMEOUT)),
-            ]
-        },
-        fallbacks=[],
-        conversation_timeout=config['BOT'].getint('timeout', 300),
-    )
-    dispatcher.add_handler(conversation_handler)
-    dispatcher.add_handler(CallbackQueryHandler(menu.admin_confirm, pattern=rf'^{CallbackData.BOOK_CONFIRM_ADMIN}'))
-    dispatcher.add_handler(CallbackQueryHandler(menu.user_confirm, pattern=rf'^{CallbackData.USER_CONFIRN_NOTIFICATION}'))
-    # prepare notifications job
-    updater.job_queue.run_repeating(menu.refresh_notifiers, config['BOT'].getint('refresh', 300))
+if __name__ == '__main__':
+    # init bot updater: handlers run in `shards` threads, updates of one user are processed sequentially
+    # Bot API connections: handlers, their I/O helpers, notification senders, job queue and updates polling
+    bot = InstrumentedBot(keyring.get_password('telegram', 'botuser'),
+                          request=Request(con_pool_size=shards + IO_WORKERS + broadcast_workers + 2))
+    job_queue = JobQueue()
+    # conversations and user sessions survive restarts
+    persistence = SQLitePersistence(persistence_path, flush_interval=config['BOT'].getint('persistence_flush', 2)) \
+        if (persistence_path := config['BOT'].get('persistence', 'data/session.sqlite')) else None
+    dispatcher = ShardedDispatcher(bot, Queue(), job_queue=job_queue, shards=shards, persistence=persistence)
+    job_queue.set_dispatcher(dispatcher)
+    updater = Updater(dispatcher=dispatcher)
+    # init handlers
+    setup_handlers(dispatcher, menu, timeout=config['BOT'].getint('timeout', 300))
+    # prepare notifications jobs: activity changes are pushed by database, full refresh is a rare safety net
+    connector.listen('activity_changed', partial(activity_changed, job_queue=updater.job_queue),
+                     on_reconnect=lambda: updater.job_queue.run_once(menu.refresh_notifiers, 0))
+    # notifiers are scheduled in settings time zone: the first full refresh waits for settings
+    refresh = config['BOT'].getint('refresh', 3600)
+    updater.job_queue.run_once(first_refresh, 0)
+    updater.job_queue.run_repeating(menu.refresh_notifiers, refresh, first=refresh)
+    # settings are reloaded on change; periodic reload is a safety net for notifications lost while disconnected
+    connector.listen('settings_changed', lambda payload: connector.refresh_settings(), on_reconnect=connector.refresh_settings)
+    updater.job_queue.run_repeating(lambda context: connector.refresh_settings(), config['BOT'].getint('settings_refresh', 300))
+    updater.job_queue.run_once(lambda context: menu.resume_broadcasts(context.job_queue), 0)
+    # redeemed tickets are written in batches
+    updater.job_queue.run_repeating(lambda context: connector.flush_redemptions(), config['BOT'].getint('redeem_flush', 5))
+    # expose metrics
+    if metrics_port := config['BOT'].getint('metrics_port', 9100):
+        start_http_server(metrics_port, config['BOT'].get('metrics_addr', '127.0.0.1'))
     # run bot
-    updater.start_polling()
+    if config['BOT'].get('mode', 'polling') == 'webhook':
+        # updates are received by local HTTP server; TLS is expected to be terminated by reverse proxy
+        webhook_path = config['BOT'].get('webhook_path', 'telegram')
+        updater.start_webhook(listen=config['BOT'].get('webhook_listen', '0.0.0.0'),
+                              port=config['BOT'].getint('webhook_port', 8443),
+                              url_path=webhook_path,
+                              webhook_url=f"{config['BOT']['webhook_url'].rstrip('/')}/{webhook_path}")
+    else:
+        updater.start_polling()
+    startup.mark('receiving updates')
     updater.idle()
+    connector.flush_redemptions()
+    if persistence is not None:
+        persistence.flush()
+    connector.close()
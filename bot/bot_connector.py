@@ -1,11 +1,24 @@
+import logging
 import re
+import time
 import keyring
+import threading
 import psycopg2
-from psycopg2.extras import DictCursor
+import pytz
+from cachetools import TTLCache
 from functools import wraps
+from pool import ConnectionPool
+from availability import AvailabilityCache
+from events import EventsCache
+from listener import Listener
+from metrics import instrument, db_method_seconds, db_method_errors, InstrumentedCursor, startup
 from menu import CallbackData
+from states import BookState, DeliveryState
 from string import punctuation
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+
+
+log = logging.getLogger(__name__)
 
 
 class ShowEvent(dict):
@@ -22,7 +35,7 @@ class ShowEvent(dict):
         return val
 
     def formatted_title(self, multirow=False):
-        return self['showtime'].strftime('%d/%m/%Y, %H:%M') + ('\n' if multirow else ' ') + self['title']
+        return self['showtime'].strftime('%d/%m/%Y, %H:%M') + ('\n' if multirow else ' ') + self['activity_title']
 
     @property
     def filename(self):
@@ -33,33 +46,126 @@ class ShowEvent(dict):
         return self['showtime'] < datetime.now()
 
 
+class Settings(dict):
+    """ Bot settings parsed once on load: numbers, time zone; `*_INTERVAL` values are parsed by database """
+    PARSERS = {
+        'MAXBOOK': int,
+        'BOT_ADMIN_ID': int,
+        'TIMEZONE': pytz.timezone,
+    }
+    # read-only paths are served with these until settings table is loaded (see `lazy_settings` of connector);
+    # booking, admin requests and notifiers wait for the loaded ones (`BotConnector.wait_settings`)
+    DEFAULTS = (
+        ('SERVICE_INTERVAL', timedelta(days=7)),
+        ('ACTUAL_INTERVAL', timedelta(hours=1)),
+        ('TIMEZONE', 'Europe/Moscow'),
+        ('MAXBOOK', '3'),
+        ('BOT_ADMIN_ID', None),
+        ('RELATED_CHANNEL', None),
+    )
+
+    def __init__(self, rows, previous=None):
+        """ Wrong values are replaced with `previous` settings ones or with defaults """
+        super().__init__()
+        for key, value in rows:
+            try:
+                self[key] = self.PARSERS[key](value) if key in self.PARSERS and value is not None else value
+            except (ValueError, pytz.UnknownTimeZoneError) as ex:
+                fallback = previous if previous is not None and key in previous else self.defaults()
+                self[key] = fallback.get(key)
+                log.error('Wrong value of setting %s: %s; %r is used', key, ex, self[key])
+
+    @classmethod
+    def defaults(cls):
+        return cls(cls.DEFAULTS)
+
+
+@instrument(db_method_seconds, db_method_errors, 'method', exclude=('manage_connection', 'wait_settings'))
 class BotConnector():
     """ PostgreSQL bot connector """
-    def __init__(self, dbname, username, *, schema='public', host='localhost', port=5432):
+    def __init__(self, dbname, username, *, schema='public', host='localhost', port=5432,
+                 pool_size=5, idle_timeout=300, max_lifetime=3600, healthcheck=30,
+                 profile_size=1024, profile_ttl=600, availability_ttl=300, activity_ttl=60, events_ttl=10, password=None,
+                 lazy_settings=False, settings_retry=5):
         self.dbname = dbname
         self.username = username
         self.schema = schema
         self.host = host
         self.port = port
-        self.__conn = None
-        self.__cursor = None
-        self.settings = self.load_settings()
+        # credentials are requested once (from keyring unless given): the pool reuses them for reconnects
+        if password is None:
+            password = keyring.get_password(dbname, username)
+        self.__dsn = dict(dbname=dbname, user=username, password=password, host=host, port=port)
+        self.__pool = ConnectionPool(pool_size, idle_timeout=idle_timeout, max_lifetime=max_lifetime, healthcheck=healthcheck, **self.__dsn)
+        self.__listener = None
+        self.__local = threading.local()      # cursor of the running method (per thread)
+        # client profiles cache
+        self.__profiles = TTLCache(maxsize=profile_size, ttl=profile_ttl)
+        self.__profiles_lock = threading.Lock()
+        # actual events list shared by users
+        self.__events = EventsCache(events_ttl)
+        # activities booking state cache
+        self.__availability = AvailabilityCache(availability_ttl)
+        # activities cache for ticket checks
+        self.__activities = TTLCache(maxsize=256, ttl=activity_ttl)
+        self.__activities_lock = threading.Lock()
+        # redeemed tickets waiting to be written and being written: {(client_id, activity_id): redeem time}
+        self.__redemptions = {}
+        self.__flushing = {}
+        self.__redemptions_lock = threading.Lock()
+        # lazy: start without database round trip, default settings are served until loaded
+        self.__settings_loaded = threading.Event()
+        self.__settings = Settings.defaults()
+        if lazy_settings:
+            threading.Thread(target=self.__load_settings, args=(settings_retry, ), name='settings-loader', daemon=True).start()
+        else:
+            self.__settings = self.load_settings()
+            self.__settings_loaded.set()
+            startup.mark('settings')
+
+    def wait_settings(self, timeout=None):
+        """ Wait until settings table is loaded (lazy start); return False on timeout """
+        return self.__settings_loaded.wait(timeout)
+
+    @property
+    def settings(self):
+        """ Current settings: replaced as a whole on refresh, so reading costs nothing """
+        return self.__settings
+
+    @property
+    def __cursor(self):
+        return self.__local.cursor
 
     def manage_connection(method):
-        """ Connection manager for methods """
+        """ Connection manager for methods: borrow pooled connection for the call """
         @wraps(method)
         def wrapper(self, *args, **kwargs):
-            self.__conn = psycopg2.connect(dbname=self.dbname, user=self.username,
-                                           password=keyring.get_password(self.dbname, self.username),
-                                           host=self.host, port=self.port)
-            self.__conn.autocommit = True
-            self.__cursor = self.__conn.cursor(cursor_factory=DictCursor)
-            result = method(self, *args, **kwargs)      # run method
-            self.__cursor.close()
-            self.__conn.close()
-            return result
+            if getattr(self.__local, 'cursor', None) is not None:      # nested call: reuse current cursor
+                return method(self, *args, **kwargs)
+            with self.__pool.connection() as conn:
+                self.__local.cursor = conn.cursor(cursor_factory=InstrumentedCursor)
+                try:
+                    return method(self, *args, **kwargs)      # run method
+                finally:
+                    self.__local.cursor.close()
+                    self.__local.cursor = None
         return wrapper
 
+    def listen(self, channel, callback, *, on_reconnect=None):
+        """ Subscribe to database notifications: `callback(payload)` is called from listener thread """
+        if self.__listener is None:
+            self.__listener = Listener(**self.__dsn)
+            self.__listener.start()
+        self.__listener.subscribe(channel, callback)
+        if on_reconnect:
+            self.__listener.on_reconnect(on_reconnect)
+
+    def close(self):
+        """ Close pooled connections and stop listener """
+        if self.__listener is not None:
+            self.__listener.stop()
+        self.__pool.closeall()
+
     @manage_connection
     def set_user(self, client_id, **kwargs):
         """ Add or update user, return admin status """
@@ -76,67 +182,198 @@ class BotConnector():
             VALUES (%s{paramholder})
             ON CONFLICT (client_id) DO {on_conflict}'''
         self.__cursor.execute(BASIC_QUERY, (client_id, *[v for k, v in kwargs.items() if k in fields]))
+        self.drop_user_cache(client_id)
+
+    def drop_user_cache(self, client_id):
+        """ Invalidate cached user profile """
+        with self.__profiles_lock:
+            self.__profiles.pop(int(client_id), None)
 
     @manage_connection
+    def __load_user(self, client_id):
+        self.__cursor.execute(f'SELECT * FROM {self.schema}.client WHERE client_id = %s', (client_id, ))
+        user_info = self.__cursor.fetchone()
+        return dict(user_info) if user_info else {}
+
+    def get_user(self, client_id):
+        """ Get all user info fields (empty if user not exists); profiles are cached """
+        client_id = int(client_id)
+        with self.__profiles_lock:
+            user_info = self.__profiles.get(client_id)
+        if user_info is None:
+            user_info = self.__load_user(client_id)
+            with self.__profiles_lock:
+                self.__profiles[client_id] = user_info
+        return user_info
+
+    @manage_connection
+    def get_users(self, client_ids):
+        """ Get info of several users in one query: {client_id: info} """
+        self.__cursor.execute(f'SELECT * FROM {self.schema}.client WHERE client_id = ANY(%s)', (list(client_ids), ))
+        users = {row['client_id']: dict(row) for row in self.__cursor.fetchall()}
+        with self.__profiles_lock:
+            self.__profiles.update(users)
+        return users
+
     def get_user_field(self, client_id, *, field, default=None):
         """ Get user info field or default if not exists """
-        self.__cursor.execute(f'SELECT {field} FROM {self.schema}.client WHERE client_id = %s', (client_id, ))
-        user_info = self.__cursor.fetchall()
-        return user_info[0].get(field, default) if user_info else {}
+        user_info = self.get_user(client_id)
+        return user_info.get(field, default) if user_info else {}
 
-    @manage_connection
     def get_events(self, mode=CallbackData.ANNOUNCE, *, uid, **kwargs):
-        """ Get required events """
+        """ Get required events: shared actual events list with booking state of user """
+        window = max(self.settings['SERVICE_INTERVAL'], self.settings['ACTUAL_INTERVAL'])
+        now, rows = self.__events.get(window, self.__load_events)
         if mode == CallbackData.SERVICE:
-            fields = ', r.visitors'
-            condition = 'a.active AND (NOW() < a.showtime + INTERVAL %s)'
-            parameters = (uid, self.settings['SERVICE_INTERVAL'], )
+            rows = [ev for ev in rows if ev['showtime'] > now - self.settings['SERVICE_INTERVAL']]
 
         elif mode in (CallbackData.ANNOUNCE, CallbackData.MYBOOKING):
-            fields = ''
-            condition = '''a.active AND (a.openreg <= NOW()) AND (NOW() < a.showtime + INTERVAL %s)'''
-            parameters = (uid, self.settings['ACTUAL_INTERVAL'], )
+            rows = [ev for ev in rows if ev['openreg'] is not None and ev['openreg'] <= now
+                    and ev['showtime'] > now - self.settings['ACTUAL_INTERVAL']]
 
         # select event
         if (eid := kwargs.get('eid', None)) is not None:
-            condition += ' AND a.activity_id = %s'
-            parameters = (*parameters, eid)
+            rows = [ev for ev in rows if ev['activity_id'] == int(eid)]
+
+        result = [ShowEvent(ev, quantity=0, redeemed=None) for ev in rows]
+        # merge user bookings
+        if uid is not None and result:
+            events = {ev['activity_id']: ev for ev in result}
+            for aid, quantity, redeemed in self.__load_bookings(uid, list(events)):
+                events[aid]['quantity'], events[aid]['redeemed'] = quantity or 0, redeemed
+        # merge booking state
+        stats = self.__availability.get([ev['activity_id'] for ev in result], self.__load_availability)
+        for ev in result:
+            st = stats[ev['activity_id']]
+            ev['left_places'] = ev['max_visitors'] - st.booked if ev['max_visitors'] is not None else None
+            if mode == CallbackData.SERVICE:
+                ev['visitors'] = list(st.visitors)
+        return result[0] if (eid is not None) and result else result
 
+    @manage_connection
+    def __load_events(self, window):
+        """ Load active events of the window: user independent fields only """
         QUERY = f'''
-            WITH reg AS
-                (SELECT
-                    activity_id,
-                    ARRAY_AGG(client_id) visitors,
-                    COALESCE(SUM(quantity), 0) booked
-                FROM {self.schema}.booking
-                WHERE quantity > 0
-                GROUP BY activity_id)
             SELECT
                 a.activity_id,
                 a.title activity_title,
                 a.announce,
                 a.info activity_info,
                 a.showtime,
+                a.openreg,
                 a.notify_at,
                 p.title place_title,
                 p.info place_info,
                 p.addr,
                 p.maplink,
-                a.max_visitors - COALESCE(r.booked, 0) left_places,
-                COALESCE(b.quantity, 0) quantity,
-                b.redeemed
-                {fields}
+                a.max_visitors,
+                a.xmin::text || '.' || p.xmin::text row_version     -- changes on every update of activity or place
             FROM {self.schema}.activity a
             JOIN {self.schema}.place p ON p.place_id = a.place
-            LEFT JOIN {self.schema}.booking b ON b.client_id = %s AND b.activity_id = a.activity_id
-            LEFT JOIN reg r ON r.activity_id = a.activity_id
-            WHERE {condition}
+            WHERE a.active AND (a.showtime > NOW() - %s)
             ORDER BY a.showtime
             '''
+        self.__cursor.execute('SELECT LOCALTIMESTAMP')
+        now = self.__cursor.fetchone()[0]
+        self.__cursor.execute(QUERY, (window, ))
+        return now, [dict(ev) for ev in self.__cursor.fetchall()]
 
-        self.__cursor.execute(QUERY, parameters)
-        result = [ShowEvent(ev) for ev in self.__cursor.fetchall()]
-        return result[0] if (eid is not None) and result else result
+    @manage_connection
+    def __load_bookings(self, client_id, activity_ids):
+        """ Load user bookings of activities: [(activity_id, quantity, redeemed)] """
+        QUERY = f'''
+            SELECT activity_id, quantity, redeemed
+            FROM {self.schema}.booking
+            WHERE client_id = %s AND activity_id = ANY(%s)'''
+        self.__cursor.execute(QUERY, (client_id, activity_ids))
+        return [tuple(row) for row in self.__cursor.fetchall()]
+
+    @manage_connection
+    def __load_availability(self, activity_ids):
+        """ Load booked places of activities visitors """
+        QUERY = f'''
+            SELECT activity_id, client_id, quantity, redeemed
+            FROM {self.schema}.booking
+            WHERE activity_id = ANY(%s) AND quantity > 0'''
+        self.__cursor.execute(QUERY, (list(activity_ids), ))
+        stats = {aid: ({}, set()) for aid in activity_ids}
+        for row in self.__cursor.fetchall():
+            visitors, redeemed = stats[row['activity_id']]
+            visitors[row['client_id']] = row['quantity']
+            if row['redeemed']:
+                redeemed.add(row['client_id'])
+        # redemptions are not committed yet
+        with self.__redemptions_lock:
+            for client_id, activity_id in [*self.__redemptions, *self.__flushing]:
+                if activity_id in stats:
+                    stats[activity_id][1].add(client_id)
+        return stats
+
+    def get_ticket(self, client_id, activity_id):
+        """ Get ticket info for check-in: event fields, booked quantity and redeemed flag; None if event is not actual
+            Served from caches: no queries while entries are fresh
+        """
+        client_id, activity_id = int(client_id), int(activity_id)
+        with self.__activities_lock:
+            ev = self.__activities.get(activity_id)
+        if ev is None:
+            ev = self.get_events(CallbackData.ANNOUNCE, uid=None, eid=activity_id) or {}
+            with self.__activities_lock:
+                self.__activities[activity_id] = ev
+        if not ev:
+            return None
+        st = self.__availability.get([activity_id], self.__load_availability)[activity_id]
+        return ShowEvent(ev, quantity=st.visitors.get(client_id, 0), redeemed=client_id in st.redeemed)
+
+    def drop_activity_cache(self, activity_id):
+        """ Invalidate cached activity of ticket checks and the events list """
+        with self.__activities_lock:
+            self.__activities.pop(int(activity_id), None)
+        self.__events.drop()
+
+    def redeem(self, client_id, activity_id):
+        """ Mark ticket as redeemed; it is written to database by `flush_redemptions` """
+        client_id, activity_id = int(client_id), int(activity_id)
+        with self.__redemptions_lock:
+            self.__redemptions[client_id, activity_id] = datetime.now(timezone.utc)
+        self.__availability.redeem(activity_id, client_id)
+
+    def __discard_redemption(self, client_id, activity_id):
+        """ Booking is changed: its pending redemption is outdated (written ones are guarded by booking time) """
+        with self.__redemptions_lock:
+            self.__redemptions.pop((int(client_id), int(activity_id)), None)
+
+    def flush_redemptions(self):
+        """ Write buffered redemptions in one query; return number of written tickets """
+        with self.__redemptions_lock:
+            if not self.__redemptions:      # no connection is taken for nothing
+                return 0
+            # batch stays visible to availability loads until committed
+            batch = self.__flushing = self.__redemptions
+            self.__redemptions = {}
+        try:
+            self.__write_redemptions(batch)
+        except psycopg2.Error as ex:
+            log.error('Redeemed tickets are not saved: %s', ex)
+            with self.__redemptions_lock:       # retry on the next flush, newer redemptions win
+                self.__redemptions = {**batch, **self.__redemptions}
+            return 0
+        finally:
+            with self.__redemptions_lock:
+                self.__flushing = {}
+        return len(batch)
+
+    @manage_connection
+    def __write_redemptions(self, batch):
+        """ Mark tickets of {(client_id, activity_id): redeem time} batch redeemed
+            Bookings changed after redeem are new ones: they are not marked
+        """
+        (client_ids, activity_ids), redeemed_at = zip(*batch), list(batch.values())
+        QUERY = f'''
+            UPDATE {self.schema}.booking b SET redeemed = TRUE, modified = NOW()
+            FROM UNNEST(%s::bigint[], %s::int[], %s::timestamptz[]) AS r(client_id, activity_id, redeemed_at)
+            WHERE b.client_id = r.client_id AND b.activity_id = r.activity_id AND b.modified <= r.redeemed_at'''
+        self.__cursor.execute(QUERY, (list(client_ids), list(activity_ids), redeemed_at))
 
     @manage_connection
     def set_registration(self, client_id, activity_id, value=None, redeemed=False):
@@ -154,8 +391,59 @@ class BotConnector():
             self.__cursor.execute(BASIC_QUERY, parameters)
         except:
             return False
+        if not redeemed:        # ticket is reset
+            self.__discard_redemption(client_id, activity_id)
+        if value is not None:
+            self.__availability.update(activity_id, client_id, value)
         return True
 
+    @manage_connection
+    def book(self, client_id, activity_id, quantity):
+        """ Check places and update user registration in one transaction; return booking state """
+        if not self.wait_settings(0):      # booking limit must not be the default one (callers wait for settings)
+            return {'status': BookState.FAILED}
+        QUERY = f'SELECT * FROM {self.schema}.book_places(%s, %s, %s, %s, %s)'
+        parameters = (client_id, activity_id, int(quantity), self.settings['MAXBOOK'], self.settings['ACTUAL_INTERVAL'])
+        try:
+            self.__cursor.execute(QUERY, parameters)
+            result = dict(self.__cursor.fetchone())
+        except psycopg2.Error:
+            return {'status': BookState.FAILED}
+        if result['status'] in (BookState.BOOKED, BookState.CANCELLED):
+            self.__discard_redemption(client_id, activity_id)
+            self.__availability.update(activity_id, client_id, result['client_quantity'])
+        return result
+
+    @manage_connection
+    def start_delivery(self, broadcast, client_ids):
+        """ Register broadcast recipients (already registered are kept); return {client_id: delivery state} """
+        self.__cursor.execute(f'''
+            INSERT INTO {self.schema}.delivery (broadcast, client_id)
+            SELECT %s, UNNEST(%s::bigint[])
+            ON CONFLICT (broadcast, client_id) DO NOTHING''', (broadcast, list(client_ids)))
+        self.__cursor.execute(f'SELECT client_id, state FROM {self.schema}.delivery WHERE broadcast = %s', (broadcast, ))
+        return dict(self.__cursor.fetchall())
+
+    @manage_connection
+    def set_delivery(self, broadcast, client_id, state):
+        """ Update delivery state of broadcast recipient """
+        self.__cursor.execute(f'''
+            UPDATE {self.schema}.delivery SET state = %s, modified = NOW()
+            WHERE broadcast = %s AND client_id = %s''', (state, broadcast, client_id))
+
+    @manage_connection
+    def close_delivery(self, broadcast):
+        """ Mark all pending recipients of broadcast as failed """
+        self.__cursor.execute(f'''
+            UPDATE {self.schema}.delivery SET state = %s, modified = NOW()
+            WHERE broadcast = %s AND state = %s''', (DeliveryState.FAILED, broadcast, DeliveryState.PENDING))
+
+    @manage_connection
+    def get_pending_broadcasts(self):
+        """ Get identifiers of interrupted broadcasts """
+        self.__cursor.execute(f'SELECT DISTINCT broadcast FROM {self.schema}.delivery WHERE state = %s', (DeliveryState.PENDING, ))
+        return [row[0] for row in self.__cursor.fetchall()]
+
     @manage_connection
     def get_visitors_info(self, activity_id):
         BASIC_QUERY = f'''
@@ -165,7 +453,52 @@ class BotConnector():
         self.__cursor.execute(BASIC_QUERY, (activity_id, ))
         return [dict(item) for item in self.__cursor.fetchall()]
 
+    @manage_connection
+    def export_visitors(self, file, *, activity_id=None, since=None, until=None):
+        """ Stream visitors of activity or of activities with showtime in [since, until) to binary `file` as CSV
+            Rows are copied by database straight to file; return number of exported bookings
+        """
+        if activity_id is not None:
+            condition, parameters = 'a.activity_id = %s', (activity_id, )
+        else:
+            condition, parameters = 'a.showtime >= %s AND a.showtime < %s', (since, until)
+        QUERY = f'''
+            SELECT a.activity_id, a.title activity_title, a.showtime,
+                   c.client_id, c.specname, c.username, c.first_name, c.last_name,
+                   b.quantity, b.redeemed, b.num_changes, b.modified
+            FROM {self.schema}.booking b
+            JOIN {self.schema}.activity a ON a.activity_id = b.activity_id
+            JOIN {self.schema}.client c ON c.client_id = b.client_id
+            WHERE {condition} AND b.quantity > 0
+            ORDER BY a.showtime, a.activity_id, c.specname'''
+        query = self.__cursor.mogrify(QUERY, parameters).decode()
+        self.__cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)', file)
+        return self.__cursor.rowcount
+
     @manage_connection
     def load_settings(self):
-        self.__cursor.execute(f'SELECT * FROM {self.schema}.settings')
-        return dict(self.__cursor.fetchall())
+        """ Read settings table """
+        self.__cursor.execute(f'''
+            SELECT key, CASE WHEN key LIKE '%%_INTERVAL' THEN value::interval END interval, value
+            FROM {self.schema}.settings''')
+        return Settings(((row['key'], row['value'] if row['interval'] is None else row['interval']) for row in self.__cursor.fetchall()),
+                        previous=self.__settings)
+
+    def refresh_settings(self):
+        """ Reload settings (on change notification or periodically); previous ones are kept on failure: return success """
+        try:
+            settings = self.load_settings()
+        except psycopg2.Error as ex:
+            log.error('Settings are not refreshed: %s', ex)
+            return False
+        if settings != self.__settings:
+            log.info('settings changed: %s', {k: v for k, v in settings.items() if self.__settings.get(k) != v})
+        self.__settings = settings
+        self.__settings_loaded.set()
+        return True
+
+    def __load_settings(self, retry):
+        """ Load settings in background until succeeded """
+        while not self.refresh_settings():
+            time.sleep(retry)
+        startup.mark('settings')
@@ -0,0 +1,92 @@
+import logging
+import time
+import threading
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import RetryAfter, TimedOut, NetworkError, Unauthorized, BadRequest
+
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """ Thread-safe token bucket rate limiter """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.__tokens = self.capacity
+        self.__updated = time.monotonic()
+        self.__paused_till = 0
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """ Wait for token """
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+                self.__updated = now
+                if now >= self.__paused_till and self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                delay = max(self.__paused_till - now, (1 - self.__tokens) / self.rate)
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        """ Hold all tokens for a period (flood control) """
+        with self.__lock:
+            self.__paused_till = max(self.__paused_till, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    """ Concurrent message sender respecting Telegram global and per-chat limits
+        Messages are retried after RetryAfter (the whole broadcast is paused) and network errors.
+    """
+    def __init__(self, *, rate=25, chat_rate=1, workers=8, retries=3):
+        self.retries = retries
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.__global = TokenBucket(rate)
+        self.__chats = TTLCache(maxsize=10000, ttl=60)       # chat_id -> TokenBucket
+        self.__chats_lock = threading.Lock()
+
+    def __chat_bucket(self, chat_id):
+        with self.__chats_lock:
+            if (bucket := self.__chats.get(chat_id)) is None:
+                bucket = self.__chats[chat_id] = TokenBucket(self.chat_rate, 1)
+            return bucket
+
+    def send_one(self, bot, chat_id, text, **kwargs):
+        """ Send message; return True on success """
+        for attempt in range(self.retries + 1):
+            self.__chat_bucket(chat_id).acquire()
+            self.__global.acquire()
+            try:
+                bot.send_message(chat_id, text, **kwargs)
+                return True
+            except RetryAfter as ex:
+                log.warning('Flood control: broadcast paused for %s seconds', ex.retry_after)
+                self.__global.pause(ex.retry_after)
+            except (Unauthorized, BadRequest) as ex:     # bot is blocked, chat not found etc
+                log.info('Message to %s is not delivered: %s', chat_id, ex)
+                return False
+            except (TimedOut, NetworkError) as ex:
+                log.warning('Message to %s is not sent (attempt %s): %s', chat_id, attempt + 1, ex)
+                time.sleep(2 ** attempt)
+        return False
+
+    def send(self, bot, messages, on_result=None):
+        """ Send messages concurrently
+            messages: iterable of (chat_id, text, kwargs); `on_result(chat_id, delivered)` is called after each message
+        """
+        def task(chat_id, text, kwargs):
+            delivered = self.send_one(bot, chat_id, text, **kwargs)
+            if on_result:
+                try:
+                    on_result(chat_id, delivered)
+                except Exception as ex:
+                    log.error('Delivery state of message to %s is not saved: %s', chat_id, ex)
+            return chat_id, delivered
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='broadcast') as executor:
+            return dict(executor.map(lambda m: task(*m), messages))
@@ -0,0 +1,82 @@
+import logging
+import threading
+from queue import Queue
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import Dispatcher
+from metrics import track_update
+
+
+log = logging.getLogger(__name__)
+
+
+class ShardedDispatcher(Dispatcher):
+    """ Dispatcher running handlers in several worker threads
+        Updates are routed to workers by user id: updates of the same user are processed one by one and in order,
+        so `user_data` (menu history etc.) is never changed concurrently.
+    """
+    def __init__(self, *args, shards=4, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shards = shards
+        self.__queues = [Queue() for _ in range(shards)]
+        self.__workers = []
+        self.__workers_lock = threading.Lock()
+        self.__process = track_update(super().process_update)
+
+    @staticmethod
+    def shard_key(update):
+        """ Serialization key of update: user id or chat id """
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return 0
+
+    def __start_workers(self):
+        with self.__workers_lock:
+            if self.__workers:
+                return
+            for n, queue in enumerate(self.__queues):
+                worker = threading.Thread(target=self.__work, args=(queue, ), name=f'update-shard-{n}', daemon=True)
+                worker.start()
+                self.__workers.append(worker)
+
+    def __work(self, queue):
+        while (update := queue.get()) is not None:
+            try:
+                self.__process(update)
+            except Exception as ex:
+                log.exception('Update processing failed: %s', ex)
+
+    def process_update(self, update):
+        """ Route update to its shard worker """
+        if isinstance(update, TelegramError):       # polling error
+            return super().process_update(update)
+        self.__start_workers()
+        self.__queues[self.shard_key(update) % self.shards].put(update)
+
+    def update_persistence(self, update=None):
+        """ Save session of the update user only (persistence stores user data only)
+            Jobs call this without update after every run: saving all sessions would pickle them again
+            on the job thread while shards change them, so nothing is done. Empty sessions
+            (conversation ended, updates outside of conversation) are evicted from memory.
+        """
+        if self.persistence is None or not isinstance(update, Update) or not update.effective_user:
+            return
+        user_id = update.effective_user.id
+        if (data := self.user_data.get(user_id)) is None:       # evicted by handler: deletion is already queued
+            return
+        if not data:
+            self.user_data.pop(user_id, None)
+        self.persistence.update_user_data(user_id, data)
+
+    def stop(self):
+        """ Stop dispatching, then let workers finish queued updates """
+        super().stop()
+        with self.__workers_lock:
+            for queue in self.__queues:
+                queue.put(None)
+            for worker in self.__workers:
+                worker.join()
+            self.__workers.clear()
@@ -0,0 +1,68 @@
+import time
+import threading
+from datetime import timedelta
+
+
+class _Load:
+    """ Running load awaited by concurrent requests """
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class EventsCache:
+    """ In-process list of actual events shared by all users
+        Loader returns (database LOCALTIMESTAMP, rows of events not older than the window); the list is reused
+        while it is younger than `ttl` seconds and covers the requested window. Time filters are applied
+        by the caller against `now()`, database time moved forward by the monotonic clock.
+        Concurrent misses wait for a single load.
+    """
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self.__entry = None        # (window, loaded monotonic time, database time, rows)
+        self.__load = None
+        self.__drops = 0           # number of invalidations: protects from storing stale loads
+        self.__lock = threading.Lock()
+
+    def get(self, window, loader):
+        """ Get (database time now, rows) loaded with `loader(window)` """
+        with self.__lock:
+            if (entry := self.__entry) and entry[0] >= window and time.monotonic() - entry[1] < self.ttl:
+                return self.__now(entry), entry[3]
+            if leader := (load := self.__load) is None:
+                load = self.__load = _Load()
+                drops = self.__drops
+        if not leader:
+            load.done.wait()
+            if load.error is not None:
+                raise load.error
+            return self.__now(load.result), load.result[3]
+        try:
+            loaded = time.monotonic()
+            dbtime, rows = loader(window)
+            load.result = entry = (window, loaded, dbtime, rows)
+        except BaseException as ex:
+            load.error = ex
+            raise
+        finally:
+            with self.__lock:
+                if self.__load is load:
+                    self.__load = None
+                if load.error is None and self.__drops == drops:       # not invalidated while loading
+                    self.__entry = entry
+            load.done.set()
+        return self.__now(entry), rows
+
+    @staticmethod
+    def __now(entry):
+        return entry[2] + timedelta(seconds=time.monotonic() - entry[1])
+
+    def drop(self):
+        """ Invalidate the list: requests coming after this don't wait for the running load """
+        with self.__lock:
+            self.__entry = None
+            self.__load = None
+            self.__drops += 1
@@ -0,0 +1,81 @@
+import logging
+from functools import partial
+from telegram import Update
+from telegram.ext import ConversationHandler, MessageHandler, CallbackQueryHandler, CommandHandler, Handler
+from telegram.ext.filters import Filters
+from states import CallbackData, ConversationState, parse_callback
+
+
+log = logging.getLogger(__name__)
+
+
+class CallbackRouter(Handler):
+    """ Callback queries handler: callback is selected by the button of callback data with one dictionary lookup
+        (instead of trying regex patterns of handlers one by one)
+    """
+    def __init__(self, routes):
+        super().__init__(callback=None)
+        self.routes = dict(routes)       # button -> callback
+
+    def check_update(self, update):
+        if isinstance(update, Update) and update.callback_query and (data := update.callback_query.data):
+            return self.routes.get(parse_callback(data)[0])
+        return None
+
+    def handle_update(self, update, dispatcher, check_result, context=None):
+        return check_result(update, context)
+
+
+def debugger(update, context):
+    """ For manual testing new features or development """
+    log.debug('DEBUGGER CALLBACK')
+
+
+def setup_handlers(dispatcher, menu, *, timeout=300):
+    """ Register menu handlers; conversations are persistent if dispatcher has persistence """
+    conversation_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler('start', menu.start),
+            CommandHandler('export', menu.export),
+            MessageHandler(Filters.text, menu.start)
+        ],
+        states={    # conversation states dictionary
+            ConversationState.FIRST_MET: [
+                MessageHandler(Filters.text, menu.first_met)
+            ],
+
+            ConversationState.MENU: [
+                CallbackRouter({
+                    'DEBUG': debugger,
+                    CallbackData.MAIN: menu.main,
+                    CallbackData.ANNOUNCE: menu.available_activities,
+                    CallbackData.MYBOOKING: menu.available_activities,
+                    CallbackData.SERVICE: menu.service_activities,
+                    CallbackData.MORE: menu.activity_info,
+                    CallbackData.SHOWMAP: menu.showmap,
+                    CallbackData.SHOWTICKET: menu.showticket,
+                    CallbackData.BOOK: menu.book,
+                    CallbackData.BOOK_CONFIRM: menu.book_confirm,
+                    CallbackData.BOOK_ACCEPT: menu.book_result,
+                    CallbackData.GOODBYE: partial(menu.direct_switch, target=CallbackData.GOODBYE),
+                    CallbackData.EXPORT: menu.export,
+                }),
+                CommandHandler('export', menu.export),
+                MessageHandler(Filters.text, menu.message)
+            ],
+
+            ConversationHandler.TIMEOUT: [
+                MessageHandler(Filters.all, menu.timeout),
+                CallbackQueryHandler(menu.timeout),
+            ]
+        },
+        fallbacks=[],
+        conversation_timeout=timeout,
+        name='menu',
+        persistent=dispatcher.persistence is not None,
+    )
+    dispatcher.add_handler(conversation_handler)
+    dispatcher.add_handler(CallbackRouter({
+        CallbackData.BOOK_CONFIRM_ADMIN: menu.admin_confirm,
+        CallbackData.USER_CONFIRN_NOTIFICATION: menu.user_confirm,
+    }))
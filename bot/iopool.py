@@ -0,0 +1,32 @@
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+IO_WORKERS = 16
+_worker = threading.local()
+_executor = ThreadPoolExecutor(IO_WORKERS, thread_name_prefix='io', initializer=lambda: setattr(_worker, 'active', True))
+
+
+def gather(*calls, return_exceptions=False):
+    """ Run independent blocking calls (database queries, Telegram requests) concurrently; return results in order
+        The last call runs in the calling thread: a single call costs no thread switch.
+        With `return_exceptions` raised exceptions are returned as results, otherwise the first one is raised.
+        Calls run in a copy of the caller context (per-update metrics are kept).
+        Nested calls from an io worker run one by one in that worker: waiting for queued ones could exhaust the pool.
+    """
+    def result(call):
+        try:
+            return call()
+        except Exception as ex:
+            if not return_exceptions:
+                raise
+            return ex
+
+    if not calls:
+        return []
+    if getattr(_worker, 'active', False):
+        return [result(call) for call in calls]
+    futures = [_executor.submit(contextvars.copy_context().run, result, call) for call in calls[:-1]]
+    last = result(calls[-1])
+    return [future.result() for future in futures] + [last]
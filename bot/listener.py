@@ -0,0 +1,85 @@
+import logging
+import select
+import threading
+import psycopg2
+
+
+log = logging.getLogger(__name__)
+
+
+class Listener(threading.Thread):
+    """ PostgreSQL notifications listener
+        Runs on its own connection; callbacks get notification payload and are called from listener thread.
+        After reconnect `on_reconnect` callbacks are called: notifications sent while disconnected are lost.
+    """
+    def __init__(self, *, reconnect_delay=5, **dsn):
+        super().__init__(name='pg-listener', daemon=True)
+        self.reconnect_delay = reconnect_delay
+        self.__dsn = dsn
+        self.__channels = {}        # channel -> list of callbacks
+        self.__reconnect_callbacks = []
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+
+    def subscribe(self, channel, callback):
+        """ Call `callback(payload)` on notification """
+        with self.__lock:
+            self.__channels.setdefault(channel, []).append(callback)
+
+    def on_reconnect(self, callback):
+        """ Call `callback()` when connection is restored """
+        with self.__lock:
+            self.__reconnect_callbacks.append(callback)
+
+    def stop(self):
+        self.__stopped.set()
+
+    def __call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception as ex:
+            log.exception('Notification callback %s failed: %s', callback, ex)
+
+    def __listen(self, conn):
+        listening = set()
+        while not self.__stopped.is_set():
+            # subscribe to channels added since last check
+            with self.__lock:
+                channels = set(self.__channels) - listening
+            if channels:
+                with conn.cursor() as cursor:
+                    for channel in channels:
+                        cursor.execute(f'LISTEN "{channel}"')
+                listening |= channels
+            if select.select([conn], [], [], 1)[0]:
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    with self.__lock:
+                        callbacks = list(self.__channels.get(notify.channel, []))
+                    for callback in callbacks:
+                        self.__call(callback, notify.payload)
+
+    def run(self):
+        connected_before = False
+        while not self.__stopped.is_set():
+            try:
+                conn = psycopg2.connect(**self.__dsn)
+            except psycopg2.Error as ex:
+                log.error('Listener connection failed: %s', ex)
+                self.__stopped.wait(self.reconnect_delay)
+                continue
+            conn.autocommit = True
+            if connected_before:
+                with self.__lock:
+                    callbacks = list(self.__reconnect_callbacks)
+                for callback in callbacks:
+                    self.__call(callback)
+            connected_before = True
+            try:
+                self.__listen(conn)
+            except (psycopg2.Error, OSError) as ex:
+                log.error('Listener connection lost: %s', ex)
+                self.__stopped.wait(self.reconnect_delay)
+            finally:
+                conn.close()
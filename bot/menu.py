@@ -1,16 +1,30 @@
+import logging
+import os
+import codecs
+import pathlib
 import re
-import qrcode
-import pytz
+import threading
 import datetime as dt
 from io import BytesIO
 from typing import List, Dict
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ParseMode
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, ParseMode
 from telegram.utils.helpers import create_deep_linked_url
-from states import ConversationState, CallbackData, ErrorState, CallbackState, HistoryState
-from functools import wraps
+from states import ConversationState, CallbackData, ErrorState, CallbackState, HistoryState, BookState, DeliveryState, parse_callback
+from broadcast import Broadcaster
+from render import RenderCache
+from tickets import TicketCache, TicketSigner
+from iopool import gather
+from metrics import instrument, handler_seconds, handler_errors
+from functools import wraps, partial, lru_cache
+from cachetools import TTLCache
 from inspect import Parameter, signature
 
 
+log = logging.getLogger(__name__)
+MAX_UPLOAD_SIZE = 50 * 2 ** 20      # Bot API limit of sent files
+SETTINGS_WAIT = 10                  # max seconds handlers wait for settings on lazy start
+
+
 def build_reply(schema: List[List], **kwargs):
     """ Create telegram chat menu as keyboard from list of lists with button names """
     return ReplyKeyboardMarkup(schema, **kwargs)
@@ -21,6 +35,17 @@ def build_inline(schema: List[Dict], **kwargs):
                                 for k, v in row.items()] for row in schema], **kwargs)
 
 
+def message_ref(message):
+    """ Compact message reference stored in session: (chat_id, message_id) """
+    return message.chat_id, message.message_id
+
+
+@lru_cache(maxsize=64)
+def back_step(value):
+    """ History slice end of BACK callback value: `back` drops the current step, `back(N)` drops N-1 steps """
+    return (-int(v.group(0)) + 1) if (v := re.search(r'\d+', value)) else -1
+
+
 def collect_card(*parts, first_bold=True):
     prepared = []
     for p in parts:
@@ -34,11 +59,25 @@ def collect_card(*parts, first_bold=True):
     return '\n'.join(prepared)
 
 
+@instrument(handler_seconds, handler_errors, 'handler', exclude=('answer', 'loaded_settings', 'parse_parameters'))
 class MenuHandler:
     """ Menu interactions handler """
-    def __init__(self, text, connector):
+    def __init__(self, text, connector, broadcaster=None, tickets=None, signer=None, renders=None, page_size=5, reports='reports'):
         self.text = text
         self.connector = connector
+        self.page_size = page_size
+        self.reports = pathlib.Path(reports)        # exported files are written here before sending
+        self.broadcaster = broadcaster or Broadcaster()
+        self.renders = renders or RenderCache()
+        self.tickets = tickets or TicketCache()
+        self.signer = signer or TicketSigner(os.urandom(32))      # NOTE random key invalidates tickets on restart
+        self.__notifiers_lock = threading.Lock()
+        # admin booking requests: activity_id -> (chat_id, message_id) of the last one
+        self.__requests = TTLCache(maxsize=1024, ttl=7 * 24 * 3600)
+        # checked tickets info: admin id -> (chat_id, message_id) of the last one (sessions end after check)
+        self.__checked = TTLCache(maxsize=256, ttl=24 * 3600)
+        self.__checked_lock = threading.Lock()
+        self.__requests_lock = threading.Lock()
 
     def answer(method):
         """ Send answer to callback """
@@ -51,29 +90,42 @@ class MenuHandler:
             return method(self, query, context, **kwargs)
         return wrapper
 
+    def loaded_settings(method):
+        """ Wait until settings are loaded (lazy start): booking limit, admin and time zone must not be defaults """
+        @wraps(method)
+        def wrapper(self, query, context, **kwargs):
+            if not self.connector.wait_settings(SETTINGS_WAIT):
+                return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.UNKNOWN)
+            return method(self, query, context, **kwargs)
+        return wrapper
+
     def parse_parameters(method):
-        """ Parse selected context parameters """
+        """ Parse selected context parameters
+            KEYWORD_ONLY parameters of handler are resolved once: their values are taken from context or defaults
+        """
+        required = tuple((pname, pvalue.default if pvalue.default != Parameter.empty else None)
+                         for pname, pvalue in signature(method).parameters.items() if pvalue.kind == Parameter.KEYWORD_ONLY)
+
         @wraps(method)
         def wrapper(self, query, context):
             # update menu callback state
-            # cbstate = CallbackState(*query.data.split(':') if hasattr(query, 'data') else [CallbackData.MAIN])    # target callback state
-            cbstate = CallbackState(*query.data.split(':') if hasattr(query, 'data') else [])    # target callback state
+            cbstate = CallbackState(*parse_callback(query.data)) if hasattr(query, 'data') else CallbackState()    # target callback state
             history = context.user_data.get('history', HistoryState([CallbackState(CallbackData.MAIN), ]))
             # update history
             if cbstate.value and cbstate.value.startswith(CallbackData.BACK):
-                step = (-int(v.group(0)) + 1) if (v := re.search(r'\d+', cbstate.value)) else -1
-                history = HistoryState(history[:step])
+                history = HistoryState(history[:back_step(cbstate.value)])
             elif cbstate.button == CallbackData.MAIN:
                 history = HistoryState([cbstate, ])
+            elif cbstate.value and cbstate.value.startswith(CallbackData.PAGE) and history.current.button == cbstate.button:
+                history[-1] = cbstate       # page switch: stay on the same sheet
             elif cbstate.button:
                 history.append(cbstate)
             context.user_data['history'] = history
             # collect required KEYWORD_ONLY parameters from context or use defaults
-            required_kw = {pname: context.user_data.get(pname, pvalue.default if pvalue.default != Parameter.empty else None)
-                           for pname, pvalue in signature(method).parameters.items() if pvalue.kind == Parameter.KEYWORD_ONLY}
+            required_kw = {pname: context.user_data.get(pname, default) for pname, default in required}
 
             # NOTE collect POSITIONAL_OR_KEYWORD parameters ?
-            print('menu history', *history, '-' * 25, sep='\n')
+            log.debug('menu history: %s', history)
 
             result = method(self, query, context, **required_kw)
             return result
@@ -88,7 +140,7 @@ class MenuHandler:
 
         # request user data
         if not (specname := self.connector.get_user_field(user['id'], field='specname')):
-            context.user_data['last_messages'] = [update.message.reply_text(self.text['MESSAGE', 'FIRST_MET'], reply_markup=None, parse_mode=ParseMode.MARKDOWN)]   # NOTE Is it possible to hide keyboard ?
+            context.user_data['last_messages'] = [message_ref(update.message.reply_text(self.text['MESSAGE', 'FIRST_MET'], reply_markup=None, parse_mode=ParseMode.MARKDOWN))]   # NOTE Is it possible to hide keyboard ?
             return ConversationState.FIRST_MET
 
         context.user_data['specname'] = specname
@@ -123,7 +175,7 @@ class MenuHandler:
         try:
             query.message.delete()
         except:
-            print(f'It seems, this message was deleted by the user: {query.message.message_id}')
+            log.debug('It seems, this message was deleted by the user: %s', query.message.message_id)
         if history.current.button == CallbackData.BOOK:
             places = ''.join(digits if (digits := re.findall(r'\d', value)) else ['0'])
             history.append(CallbackState(CallbackData.BOOK_CONFIRM, places))
@@ -141,14 +193,13 @@ class MenuHandler:
         kbd = build_inline([
             {self.text['BUTTON', 'ANNOUNCE']: CallbackData.ANNOUNCE},
             {self.text['BUTTON', 'BOOKING']: CallbackData.MYBOOKING},
-            # {self.text['BUTTON', 'SERVICE']: CallbackData.SERVICE} if is_admin else {},
+            {self.text['BUTTON', 'SERVICE']: CallbackData.SERVICE} if is_admin else {},
             {self.text['BUTTON', 'ABOUT']: CallbackData.ABOUT},
             {self.text['BUTTON', 'GOODBYE']: CallbackData.GOODBYE},
             # {'debug action': 'DEBUG'} if is_admin else {},
         ])
-        self.__delete_messages(context)
         infotext = self.text['MESSAGE', 'WELCOME', 2] if (history.prev.button == CallbackData.MAIN) else self.text['MESSAGE', 'WELCOME', cvstate] % context.user_data['specname']
-        context.user_data['last_messages'] = [query.message.reply_text(infotext, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
+        self.__replace_messages(context, lambda: query.message.reply_text(infotext, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))
         return ConversationState.MENU
 
     @answer
@@ -162,7 +213,7 @@ class MenuHandler:
         booked = [ev for ev in events if ev['quantity']]
         # build zero-events keyboard
         kbd = build_inline([
-            {self.text['BUTTON', 'TO_RELATED_CHANNEL']: {'url': self.connector.settings['RELATED_CHANNEL']}},      # NOTE is it possible to handle this button?
+            {self.text['BUTTON', 'TO_RELATED_CHANNEL']: {'url': channel}} if (channel := self.connector.settings['RELATED_CHANNEL']) else {},      # NOTE is it possible to handle this button?
             {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN}
         ]) if not events else build_inline([
             {self.text['BUTTON', 'TO_ANNOUNCE']: CallbackData.ANNOUNCE},
@@ -174,27 +225,25 @@ class MenuHandler:
         elif history.current.button == CallbackData.MYBOOKING:      # for BOOKING: check announces
             TEXT = self.text['MESSAGE', 'BOOKS', bool(booked) if events else 2]
             events = booked
-        # push message
-        evlist = [query.message.edit_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
-        # collect events list
-        for num, ev in enumerate(events, 1):
-            kbd = build_inline([
-                {
-                    self.text['BUTTON', 'MORE']: f'{CallbackData.MORE}:{ev["activity_id"]}',
-                    self.text['BUTTON', 'BOOK', bool(ev['quantity'])]: f'{CallbackData.BOOK}:{ev["activity_id"]}'
-                },
-                # {self.text['BUTTON', 'BACK']: f'{context.user_data["history"][-2].button}'} if num == len(events) else {},    # BACK button example
-                {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN} if num == len(events) else {},
-            ])
-            # TODO настроить отображение карточки анонса
-            TEXT = f"*{ev['activity_title']}*\n" \
-                   f"{ev['showtime'].strftime('%d/%m/%Y %H:%M')}, {ev['place_title']}\n" \
-                   f"{(ev['announce']) if ev['announce'] else ''}\n" \
-                   f"{self.text['FILLER', 'LEFT_PLACES', ev['left_places'] > 0] % ((ev['left_places'],) if ev['left_places'] > 0 else ())}\n" \
-                   f""
-                   # TODO текст по state: про места, очередь, бронирование итп
-            evlist.append(query.message.reply_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))
-        context.user_data['last_messages'] = evlist
+        # collect events list page
+        page, pages, offset = self.__page(history.current.value, len(events))
+        shown = events[offset:offset + self.page_size]
+        # TODO текст по state: про места, очередь, бронирование итп
+        cards = [f"{num}. {self.__announce_card(ev)}" for num, ev in enumerate(shown, offset + 1)]
+        if events:
+            # keyboard depends on user only by booked flags of shown events
+            key = ('list', history.current.button, page, pages, offset,
+                   tuple((ev['activity_id'], bool(ev['quantity'])) for ev in shown), self.text.version)
+            kbd = self.renders.get(key, lambda: build_inline([
+                *({
+                    f"{num}. {self.text['BUTTON', 'MORE']}": f'{CallbackData.MORE}:{ev["activity_id"]}',
+                    f"{num}. {self.text['BUTTON', 'BOOK', bool(ev['quantity'])]}": f'{CallbackData.BOOK}:{ev["activity_id"]}'
+                } for num, ev in enumerate(shown, offset + 1)),
+                self.__page_buttons(history.current.button, page, pages),
+                {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN},
+            ]))
+        # push single message
+        context.user_data['last_messages'] = [message_ref(query.message.edit_text(self.__page_text(TEXT, cards, page, pages), reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))]
         return ConversationState.MENU
 
     @answer
@@ -210,49 +259,133 @@ class MenuHandler:
             {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN}
         ]) if not events else None
         TEXT = self.text['MESSAGE', 'ANNOUNCE', 2 + bool(events)]
-        # push message
-        evlist = [query.message.edit_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
-        # collect events list
-        for num, ev in enumerate(events, 1):
+        # collect events list page
+        page, pages, offset = self.__page(history.current.value, len(events))
+        cards = [f"{num}. *{ev['activity_title']}*\n"
+                 f"{ev['showtime'].strftime('%d/%m/%Y %H:%M')}, {ev['place_title']}"
+                 for num, ev in enumerate(events[offset:offset + self.page_size], offset + 1)]
+        if events:
             kbd = build_inline([
-                {
-                    'demo button': f'demo:{ev["activity_id"]}'
-                },
-                {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN} if num == len(events) else {},
+                *({f"{num}. {self.text['BUTTON', 'EXPORT']}": f'{CallbackData.EXPORT}:{ev["activity_id"]}'}
+                  for num, ev in enumerate(events[offset:offset + self.page_size], offset + 1)),
+                self.__page_buttons(history.current.button, page, pages),
+                {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN},
             ])
-            # prepare infocard
-            TEXT = f"*{ev['activity_title']}*\n" \
-                   f"{ev['showtime'].strftime('%d/%m/%Y %H:%M')}, {ev['place_title']}\n"
-            evlist.append(query.message.reply_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))
-        context.user_data['last_messages'] = evlist
+        # push single message
+        context.user_data['last_messages'] = [message_ref(query.message.edit_text(self.__page_text(TEXT, cards, page, pages), reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))]
         return ConversationState.MENU
 
+    def export(self, update, context):
+        """ Send visitors list as CSV file (admins only)
+            Activity is selected by service list button or by `/export` command arguments: activity id or dates range
+        """
+        if query := update.callback_query:
+            query.answer()
+        uid = update.effective_user.id
+        if not self.connector.get_user_field(uid, field='is_admin'):
+            return None
+        if (criteria := self.__export_criteria([parse_callback(query.data)[1]] if query else context.args)) is None:
+            context.bot.send_message(uid, self.text['MESSAGE', 'EXPORT', 0])
+            return None
+        if 'activity_id' in criteria:
+            ev = self.connector.get_events(CallbackData.SERVICE, uid=None, eid=criteria['activity_id'])
+            filename = ev.filename if ev else f"activity_{criteria['activity_id']}.csv"
+        else:
+            filename = f"visitors_{criteria['since']:%Y-%m-%d}_{criteria['until'] - dt.timedelta(days=1):%Y-%m-%d}.csv"
+        # rows are streamed by database to file: memory usage doesn't depend on list size
+        self.reports.mkdir(parents=True, exist_ok=True)
+        path = self.reports / f'{uid}_{filename}'
+        try:
+            with open(path, 'wb') as file:
+                file.write(codecs.BOM_UTF8)     # spreadsheet editors detect encoding by BOM
+                rows = self.connector.export_visitors(file, **criteria)
+            if not rows:
+                context.bot.send_message(uid, self.text['MESSAGE', 'EXPORT', 1])
+            elif path.stat().st_size > MAX_UPLOAD_SIZE:
+                context.bot.send_message(uid, self.text['MESSAGE', 'EXPORT', 2])
+            else:
+                with open(path, 'rb') as file:
+                    context.bot.send_document(uid, file, filename=filename, caption=self.text['MESSAGE', 'EXPORT', 3] % rows)
+        finally:
+            path.unlink(missing_ok=True)
+        return None
+
+    @staticmethod
+    def __export_criteria(args):
+        """ Export filter from arguments: activity id or one or two dates (inclusive range) """
+        try:
+            if len(args) == 1 and args[0] and args[0].isdigit():
+                return {'activity_id': int(args[0])}
+            if 1 <= len(args) <= 2:
+                dates = [dt.date.fromisoformat(arg) for arg in args]
+                return {'since': dates[0], 'until': dates[-1] + dt.timedelta(days=1)}
+        except (ValueError, TypeError):
+            pass
+        return None
+
+    def __announce_card(self, ev):
+        """ Events list card without number """
+        # TODO настроить отображение карточки анонса
+        key = ('card', ev['activity_id'], ev['row_version'], ev['left_places'], self.text.version)
+        return self.renders.get(key, lambda:
+            f"*{ev['activity_title']}*\n"
+            f"{ev['showtime'].strftime('%d/%m/%Y %H:%M')}, {ev['place_title']}\n"
+            f"{(ev['announce']) if ev['announce'] else ''}\n"
+            f"{self.text['FILLER', 'LEFT_PLACES', ev['left_places'] > 0] % ((ev['left_places'],) if ev['left_places'] > 0 else ())}")
+
+    def __back_keyboard(self, history):
+        """ BACK & MAIN keyboard """
+        return self.renders.get(('back', history.prev.button, self.text.version), lambda: build_inline([
+            {self.text['BUTTON', 'BACK']: f'{history.prev.button}:{CallbackData.BACK}'},
+            {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN}
+        ]))
+
+    def __page(self, value, count):
+        """ Get (page, pages, offset) of events list from callback value `page<N>` """
+        pages = max(1, -(-count // self.page_size))
+        page = int(v.group(0)) if value and value.startswith(CallbackData.PAGE) and (v := re.search(r'\d+', value)) else 1
+        page = min(max(page, 1), pages)
+        return page, pages, (page - 1) * self.page_size
+
+    def __page_buttons(self, button, page, pages):
+        """ Paging keyboard row """
+        return {
+            **({self.text['BUTTON', 'PAGE', 0]: f'{button}:{CallbackData.PAGE}{page - 1}'} if page > 1 else {}),
+            **({self.text['BUTTON', 'PAGE', 1]: f'{button}:{CallbackData.PAGE}{page + 1}'} if page < pages else {}),
+        }
+
+    def __page_text(self, head, cards, page, pages):
+        """ Events list message text """
+        return '\n\n'.join([head, *cards, *([self.text['FILLER', 'PAGE'] % (page, pages)] if pages > 1 else [])])
+
     @answer
     @parse_parameters
     def activity_info(self, query, context, *,  history, uid, evfilter):
         """ Show activity large infocard """
-        self.__delete_messages(context)
         # request event information depending on pressed button
         ev = self.connector.get_events(evfilter, uid=uid, eid=history.current.value)
         if not ev:
             return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.UNAVAILABLE)
         # prepare infocard
-        TEXT = f"*{ev['activity_title']}*\n" \
-               f"{ev['showtime'].strftime('%d/%m/%Y %H:%M')}, {ev['place_title']}\n" \
-               f"{ev['addr']}\n" \
-               f"{ev['activity_info']}\n" \
-               f"{self.text['FILLER', 'LEFT_PLACES', ev['left_places'] > 0].agree_with_number(*(ev['left_places'],) if ev['left_places'] > 0 else ())}"
+        key = ('info', ev['activity_id'], ev['row_version'], ev['left_places'], self.text.version)
+        TEXT = self.renders.get(key, lambda:
+               f"*{ev['activity_title']}*\n"
+               f"{ev['showtime'].strftime('%d/%m/%Y %H:%M')}, {ev['place_title']}\n"
+               f"{ev['addr']}\n"
+               f"{ev['activity_info']}\n"
+               f"{self.text['FILLER', 'LEFT_PLACES', ev['left_places'] > 0].agree_with_number(*(ev['left_places'],) if ev['left_places'] > 0 else ())}")
             #    f"{self.text['FILLER', 'LEFT_PLACES', ev['left_places'] > 0] % ((ev['left_places'],) if ev['left_places'] > 0 else ())}"
-        # prepare keyboard
-        kbd = build_inline([
+        # prepare keyboard: user dependent by booked flag only
+        key = ('info', ev['activity_id'], bool(ev['quantity']), history.prev.button, self.text.version)
+        kbd = self.renders.get(key, lambda: build_inline([
             {self.text['BUTTON', 'BOOK', bool(ev['quantity'])]: f'{CallbackData.BOOK}:{ev["activity_id"]}'},
             {self.text['BUTTON', 'SHOWMAP']: f'{CallbackData.SHOWMAP}:{ev["activity_id"]}'},
             {self.text['BUTTON', 'SHOWTICKET']: f'{CallbackData.SHOWTICKET}:{ev["activity_id"]}'} if ev['quantity'] else {},       # TODO
             {self.text['BUTTON', 'BACK']: f'{history.prev.button}:{CallbackData.BACK}'},
             {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN}
-        ])
+        ]))
         # push message
-        context.user_data['last_messages'] = [query.message.reply_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
+        self.__replace_messages(context, lambda: query.message.reply_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))
         return ConversationState.MENU
 
     @answer
@@ -263,18 +396,16 @@ class MenuHandler:
         ev = self.connector.get_events(evfilter, uid=uid, eid=history.current.value)
         if not ev:
             return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.UNAVAILABLE)
-        TEXT = collect_card(ev['place_title'],
-                            ev['place_info'],
-                            ev['addr'],
-                            (ev['maplink'], self.text["FILLER", "SHOWMAP"]),
-                            )
+        key = ('map', ev['activity_id'], ev['row_version'], self.text.version)
+        TEXT = self.renders.get(key, lambda: collect_card(ev['place_title'],
+                                                          ev['place_info'],
+                                                          ev['addr'],
+                                                          (ev['maplink'], self.text["FILLER", "SHOWMAP"]),
+                                                          ))
         # prepare keyboard
-        kbd = build_inline([
-            {self.text['BUTTON', 'BACK']: f'{history.prev.button}:{CallbackData.BACK}'},
-            {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN}
-        ])
+        kbd = self.__back_keyboard(history)
         # push message
-        context.user_data['last_messages'] = [query.message.edit_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]   # disable_web_page_preview
+        context.user_data['last_messages'] = [message_ref(query.message.edit_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))]   # disable_web_page_preview
         return ConversationState.MENU
 
     @answer
@@ -287,13 +418,11 @@ class MenuHandler:
             return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.UNAVAILABLE)
         if ev['quantity'] == 0:
             return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.FORBIDDEN)
-        # generate ticket
-        ticket_link = create_deep_linked_url(context.bot.username, f'{uid}_{ev["activity_id"]}')
-        image = qrcode.make(ticket_link)
-        # convert PIL to bytes
-        bimage = BytesIO()
-        image.save(bimage, 'JPEG')
-        bimage.seek(0)
+        # reuse uploaded ticket or render it
+        ticket = (uid, ev['activity_id'])
+        if (photo := self.tickets.file_id(ticket)) is None:
+            ticket_link = create_deep_linked_url(context.bot.username, self.signer.sign(uid, ev['activity_id']))
+            photo = BytesIO(self.tickets.image(ticket, ticket_link))
 
         # prepare keyboard
         kbd = build_inline([
@@ -301,23 +430,25 @@ class MenuHandler:
             {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN}
         ])
         # push message
-        self.__delete_messages(context)
-        context.user_data['last_messages'] = [query.message.reply_photo(bimage, caption='', reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
-        bimage.close()
+        message = self.__replace_messages(context, lambda: query.message.reply_photo(photo, caption='', reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))
+        if message.photo:
+            self.tickets.set_file_id(ticket, message.photo[-1].file_id)
         return ConversationState.MENU
         # return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.INDEV)
 
     @answer
+    @loaded_settings
     @parse_parameters
     def book(self, query, context, *, history, uid, evfilter):
         """ Booking sheet """
-        # request event information depending on menu section
-        ev = self.connector.get_events(evfilter, uid=uid, eid=history.current.value)
+        # request event information depending on menu section and user profile concurrently
+        ev, specname = gather(lambda: self.connector.get_events(evfilter, uid=uid, eid=history.current.value),
+                              lambda: self.connector.get_user_field(uid, field='specname'))
         if not ev:
             return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.UNAVAILABLE)
         # prepare infocard
         parameters = (
-            self.connector.get_user_field(uid, field='specname'),
+            specname,
             ev['activity_title'],
             ev['showtime'].strftime('%d/%m/%Y'),
             ev['showtime'].strftime('%H:%M'),
@@ -325,21 +456,23 @@ class MenuHandler:
         )
         # left_places_state = ev['left_places'] if ev['left_places'] < 2 else 2
         left_places_state = 0 if ev['left_places'] < 0 else 2 if ev['left_places'] > 2 else ev['left_places']
-        # TEXT without BOOK_IS_CONFIRMED text
-        TEXT = self.text['MESSAGE', 'BOOK_PROCESS_HEAD', ev['quantity'] > 0] % parameters + \
-               f" {self.text['MESSAGE', 'BOOK_PROCESS_BODY', left_places_state].agree_with_number(*(ev['left_places'],) if ev['left_places'] > 1 else ())}" + \
-               (f"\n{self.text['MESSAGE', 'BOOK_PROCESS_BODY', 3].agree_with_number(ev['quantity'])}" if ev['quantity'] else "") + \
-               f" {self.text['MESSAGE', 'BOOK_PROCESS_FINAL', ev['quantity'] > 0]}"
+        # TEXT without BOOK_IS_CONFIRMED text: head is personal, the rest depends on numbers only
+        key = ('book', ev['left_places'], ev['quantity'], self.text.version)
+        TEXT = self.text['MESSAGE', 'BOOK_PROCESS_HEAD', ev['quantity'] > 0] % parameters + self.renders.get(key, lambda:
+               f" {self.text['MESSAGE', 'BOOK_PROCESS_BODY', left_places_state].agree_with_number(*(ev['left_places'],) if ev['left_places'] > 1 else ())}" +
+               (f"\n{self.text['MESSAGE', 'BOOK_PROCESS_BODY', 3].agree_with_number(ev['quantity'])}" if ev['quantity'] else "") +
+               f" {self.text['MESSAGE', 'BOOK_PROCESS_FINAL', ev['quantity'] > 0]}")
         # TEXT = self.text['MESSAGE', 'BOOK_PROCESS_HEAD', ev['quantity'] > 0] % parameters + \
         #        f" {self.text['MESSAGE', 'BOOK_PROCESS_BODY', left_places_state].agree_with_number(e*(ev['left_places'],) if ev['left_places'] > 1 else ())}" + \
         #        (f"\n{self.text['MESSAGE', 'BOOK_PROCESS_BODY', 3].agree_with_number(ev['quantity'])} {self.text['MESSAGE', 'BOOK_IS_CONFIRMED', ev['confirmed']]}" if ev['quantity'] else "") + \
         #        f" {self.text['MESSAGE', 'BOOK_PROCESS_FINAL', ev['quantity'] > 0]}"
         # prepare keyboard
-        MAXBOOK = int(self.connector.settings['MAXBOOK'])
+        MAXBOOK = self.connector.settings['MAXBOOK']
         one_ticket_state = 2 * bool(ev['left_places'] + ev['quantity'] > 1) + (ev['left_places'] == 1 and not ev['quantity'])
         # available_range = range(1, min(MAXBOOK + 1, ev['left_places'] + ev['quantity']) + 1)
         available_range = range(1, min(MAXBOOK, ev['left_places'] + ev['quantity']) + 1)
-        kbd = build_inline([
+        key = ('book', ev['left_places'], ev['quantity'], MAXBOOK, history.prev.button, self.text.version)
+        kbd = self.renders.get(key, lambda: build_inline([
             {} if not one_ticket_state else      # booked 1 place and no places left -> don't show book choises
             {self.text['BUTTON', 'BOOK_QUANTITY']: f'{CallbackData.BOOK_CONFIRM}:1'} if one_ticket_state == 1 else
             {n: f'{CallbackData.BOOK_CONFIRM}:{n}' for n in available_range if n != ev['quantity']},
@@ -348,13 +481,13 @@ class MenuHandler:
             {self.text['BUTTON', 'BACK']: f'{history.prev.button}:{CallbackData.BACK}'},
             # {self.text['BUTTON', 'MORE']: f'{CallbackData.MORE}:{ev["activity_id"]}'},      # NOTE backup
             {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN}
-        ])
+        ]))
         # push message
-        self.__delete_messages(context)
-        context.user_data['last_messages'] = [query.message.reply_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
+        self.__replace_messages(context, lambda: query.message.reply_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))
         return ConversationState.MENU
 
     @answer
+    @loaded_settings
     @parse_parameters
     def book_confirm(self, query, context, *, history, uid, evfilter):
         """ Confirm booking """
@@ -362,7 +495,7 @@ class MenuHandler:
         ev = self.connector.get_events(evfilter, uid=uid, eid=history.prev.value)
         if not ev:
             return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.UNAVAILABLE)
-        MAXBOOK = int(self.connector.settings['MAXBOOK'])
+        MAXBOOK = self.connector.settings['MAXBOOK']
         # prepare text
         state = v if (v := int(history.current.value)) < 2 else 2
         parameters = (
@@ -395,33 +528,26 @@ class MenuHandler:
         }
         # push message
         # context.user_data['last_messages'] = [query.message.edit_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
-        context.user_data['last_messages'] = [context.user_data['last_messages'][-1].edit_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
+        context.bot.edit_message_text(TEXT, *context.user_data['last_messages'][-1], reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)
+        context.user_data['last_messages'] = context.user_data['last_messages'][-1:]
         return ConversationState.MENU
 
     @answer
+    @loaded_settings
     @parse_parameters
-    def book_result(self, query, context, *, history, uid, nickname, evfilter, notification={}):
+    def book_result(self, query, context, *, history, uid, nickname, evfilter):
         # clean part of context
         action_params = context.user_data.pop('action_params')
-        # request event information
-        ev = self.connector.get_events(evfilter, uid=uid, eid=action_params['activity_id'])
-        if not ev:
+        # check places and book on server side in one transaction
+        book_state = self.connector.book(uid, action_params['activity_id'], action_params['quantity'])['status']
+        if book_state == BookState.UNAVAILABLE:
             return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.UNAVAILABLE)
 
-        # NOTE check SQL-side?
-        drop_book_state = int(action_params['quantity']) == 0
-        if free_places_state := (int(ev['left_places']) + int(ev['quantity'])) >= int(action_params['quantity']):
-            # autoconfirm = (int(action_params['quantity']) <= int(self.connector.settings['MAXBOOK'])) or (bool(ev['confirmed']) and (int(action_params['quantity']) <= ev['quantity']))
-            autoconfirm = (int(action_params['quantity']) <= int(self.connector.settings['MAXBOOK'])) or (int(action_params['quantity']) <= ev['quantity'])
-        else:
-            autoconfirm = False
-
         # request admin confirmation if required
-        if autoconfirm:
-            # book_state = self.connector.set_registration(uid, action_params['activity_id'], action_params['quantity'], autoconfirm)     # for additional confirmation feature
-            book_state = self.connector.set_registration(uid, action_params['activity_id'], action_params['quantity'])
-        elif free_places_state:
-            book_state = False
+        if book_state == BookState.REQUESTED:
+            ev = self.connector.get_events(evfilter, uid=uid, eid=action_params['activity_id'])
+            if not ev:
+                return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.UNAVAILABLE)
             parameters = (
                 self.connector.get_user_field(uid, field='specname'),
                 action_params['quantity'],
@@ -439,17 +565,18 @@ class MenuHandler:
                 {self.text['BUTTON', 'APPLICANT_CHAT']: {'url': CallbackData.USER_LINK[bool(nickname)] % (nickname if nickname else uid)}}
             ])
             # delete previous notification
-            if ev["activity_id"] in notification:
+            with self.__requests_lock:
+                request = self.__requests.pop(ev['activity_id'], None)
+            if request:
                 try:
-                    notification[ev["activity_id"]].delete()
+                    context.bot.delete_message(*request)
                 except:
-                    notification.pop(ev["activity_id"])
-            notification[ev["activity_id"]] = context.bot.send_message(self.connector.settings['BOT_ADMIN_ID'], TEXT, reply_markup=kbd)
-            context.user_data['notification'] = notification
-        else:
-            book_state = False
+                    log.debug('It seems, this message was deleted by the user: %s', request[1])
+            request = message_ref(context.bot.send_message(self.connector.settings['BOT_ADMIN_ID'], TEXT, reply_markup=kbd))
+            with self.__requests_lock:
+                self.__requests[ev['activity_id']] = request
         # prepare text
-        TEXT = self.text['MESSAGE', 'BOOK_RESULT', free_places_state + autoconfirm + book_state + drop_book_state]
+        TEXT = self.text['MESSAGE', 'BOOK_RESULT', book_state]
         # prepare keyboard
         kbd = build_inline([
             {},
@@ -457,10 +584,11 @@ class MenuHandler:
             {self.text['BUTTON', 'TO_MAIN_MENU']: CallbackData.MAIN},
         ])
         # push message
-        context.user_data['last_messages'] = [query.message.edit_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
+        context.user_data['last_messages'] = [message_ref(query.message.edit_text(TEXT, reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))]
         return ConversationState.MENU
 
     @answer
+    @loaded_settings
     @parse_parameters
     def admin_confirm(self, query, context, *, history):
         """ Admin book confirmation """
@@ -494,27 +622,29 @@ class MenuHandler:
         try:
             query.message.delete()
         except:
-            print(f'It seems, this message was deleted by the user: {query.message.message_id}')
+            log.debug('It seems, this message was deleted by the user: %s', query.message.message_id)
         # backward notification
         context.bot.send_message(uid, self.text['MESSAGE', 'BOOK_CONFIRM_RESPONSE', state > 0])
         return ConversationState.END        # NOTE это сбрасывает диалог, если он был
 
     @parse_parameters
-    def check_ticket(self, query, context, *, uid, ticketmsg):
-        client_id, activity_id = context.args[0].split('_')
+    def check_ticket(self, query, context, *, uid):
+        # verify ticket signature: forged links are rejected without database access
+        if (ticket := self.signer.verify(context.args[0])) is None:
+            return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.FORBIDDEN)
+        client_id, activity_id = ticket
         # get users booking info
-        ev = self.connector.get_events(CallbackData.ANNOUNCE, uid=client_id, eid=activity_id)
+        ev = self.connector.get_ticket(client_id, activity_id)
         if not ev:
             return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.UNAVAILABLE)
-        # redeem ticket
-        redeem_state = (ev['quantity'] > 0) and self.connector.set_registration(client_id, activity_id, redeemed=True)
-        if not redeem_state:
+        if ev['quantity'] == 0:
             return self.direct_switch(query, context, target=CallbackData.ERROR, errstate=ErrorState.SERVERSIDE)
+        # redeem ticket: saved in background
+        self.connector.redeem(client_id, activity_id)
+        with self.__checked_lock:
+            ticketmsg = self.__checked.pop(uid, None)
         if ticketmsg:
-            try:
-                ticketmsg.delete()
-            except:
-                print(f'It seems, this message was deleted by the user: {ticketmsg}')
+            self.__delete_message(context.bot, ticketmsg)
         # prepare text
         parameters = (
             ev['quantity'],
@@ -525,19 +655,26 @@ class MenuHandler:
         # prepare text            
         TEXT = self.text['MESSAGE', 'TICKET_INFO', ev['quantity'] > 0].agree_with_number(*parameters if ev['quantity'] > 0 else ()) + \
             (f"\n{self.text['MESSAGE', 'REDEEMED']}" if ev['redeemed'] else '')
-        context.user_data['ticketmsg'] = context.bot.send_message(uid, TEXT)
+        message = message_ref(context.bot.send_message(uid, TEXT))
+        with self.__checked_lock:
+            self.__checked[uid] = message
+        self.__end_session(query, context)
         return ConversationState.END
 
-    def __delete_messages(self, context):
-        evlist = context.user_data.get('last_messages', None)
-        if not evlist:
-            return
-        for ev in evlist:
-            try:
-                ev.delete()
-            except:
-                print(f'It seems, this message was deleted by the user: {ev["message_id"]}')
-        context.user_data['last_messages'] = []
+    @staticmethod
+    def __delete_message(bot, ref):
+        try:
+            bot.delete_message(*ref)
+        except Exception:
+            log.debug('It seems, this message was deleted by the user: %s', ref[1])
+
+    def __replace_messages(self, context, send):
+        """ Delete previous messages and send the new one concurrently; return sent message """
+        evlist = context.user_data.get('last_messages', None) or []
+        # one flat batch: deletions don't wait for io workers from an io worker
+        message = gather(*(partial(self.__delete_message, context.bot, ref) for ref in evlist), send)[-1]
+        context.user_data['last_messages'] = [message_ref(message)]
+        return message
 
     @answer
     def direct_switch(self, query, context, *, target, errstate=ErrorState.UNKNOWN, safemode=True):
@@ -555,16 +692,39 @@ class MenuHandler:
         else:
             target = CallbackData.ERROR
             errstate = ErrorState.UNKNOWN
-        # otherwise clear and close conversation
-        self.__delete_messages(context)
-        context.user_data.clear()
+        # otherwise close conversation: previous messages are replaced, then session is evicted
         kbd = build_reply([[self.text['BUTTON', 'HELLO']]], one_time_keyboard=True, resize_keyboard=True)
-        context.user_data['last_messages'] = [query.message.reply_text(self.text['MESSAGE', target, errstate if target == CallbackData.ERROR else '@random'], reply_markup=kbd, parse_mode=ParseMode.MARKDOWN)]
+        self.__replace_messages(context, lambda: query.message.reply_text(self.text['MESSAGE', target, errstate if target == CallbackData.ERROR else '@random'], reply_markup=kbd, parse_mode=ParseMode.MARKDOWN))
+        self.__end_session(query, context)
         return ConversationState.END
-    
-    def notify(self, context):        
-        print(f'send notification for activity {context.job.context["activity_id"]}')
-        ev = self.connector.get_events(CallbackData.SERVICE, uid=None, eid=context.job.context["activity_id"])
+
+    @staticmethod
+    def __end_session(query, context):
+        """ Evict user session of closed conversation from memory and storage """
+        if (user := query.effective_user if isinstance(query, Update) else query.from_user) is None:
+            return
+        context.dispatcher.user_data.pop(user.id, None)
+        if hasattr(context.dispatcher.persistence, 'drop_user_data'):
+            context.dispatcher.persistence.drop_user_data(user.id)
+
+    def timeout(self, update, context):
+        """ Close timed out conversation (user session is evicted) """
+        return self.direct_switch(update, context, target=CallbackData.ERROR, errstate=ErrorState.TIMEOUT)
+
+    def notify(self, context):
+        """ Send notification to activity visitors; interrupted broadcast is resumed by its identifier """
+        activity_id = context.job.context['activity_id']
+        log.info('send notification for activity %s', activity_id)
+        ev = self.connector.get_events(CallbackData.SERVICE, uid=None, eid=activity_id)
+        if not ev:
+            if broadcast := context.job.context.get('broadcast'):
+                self.connector.close_delivery(broadcast)
+            return
+        broadcast = context.job.context.get('broadcast') or f'notify:{activity_id}:{ev["notify_at"] or ev["showtime"]:%Y%m%d%H%M}'
+        # register recipients and skip already notified
+        delivery = self.connector.start_delivery(broadcast, ev['visitors'])
+        recipients = [v for v, state in delivery.items() if state == DeliveryState.PENDING]
+        users = self.connector.get_users(recipients)
         # prepare keyboard
         kbd = build_inline([
             {
@@ -572,44 +732,70 @@ class MenuHandler:
                 self.text['BUTTON', 'CONFIRM', 0]: f'{CallbackData.USER_CONFIRN_NOTIFICATION}:0,{ev["activity_id"]}',
             },
         ])
-        # prepare notification
-        for visitor in ev['visitors']:
+        # prepare notifications
+        messages = []
+        for visitor in recipients:
             parameters = (
-                self.connector.get_user_field(visitor, field='specname'),
+                users.get(visitor, {}).get('specname'),
                 ev['activity_title'],
                 ev['showtime'].strftime('%d/%m/%Y'),
                 ev['showtime'].strftime('%H:%M'),
                 ev['place_title'],
             )
-            TEXT = self.text['MESSAGE', 'NOTIFICATION'] % parameters
-            context.bot.send_message(visitor, TEXT, reply_markup=kbd)
+            messages.append((visitor, self.text['MESSAGE', 'NOTIFICATION'] % parameters, {'reply_markup': kbd}))
+        self.broadcaster.send(context.bot, messages,
+                              on_result=lambda visitor, ok: self.connector.set_delivery(broadcast, visitor, DeliveryState.SENT if ok else DeliveryState.FAILED))
+
+    def resume_broadcasts(self, job_queue):
+        """ Schedule interrupted broadcasts """
+        for broadcast in self.connector.get_pending_broadcasts():
+            activity_id = int(broadcast.split(':')[1])
+            log.info('resume notification %s', broadcast)
+            job_queue.run_once(self.notify, 0, context={'activity_id': activity_id, 'broadcast': broadcast}, name=f'resume:{broadcast}')
 
     @answer
     @parse_parameters
     def user_confirm(self, query, context):
         """ User notify confirmation """
         query.message.delete()
-        print(query.data)
+        log.debug('admin confirmation: %s', query.data)
         # TODO reset booking if NO
 
-    def refresh_notifiers(self, context):
-        """ Refresh notifier jobs """
-        # collect jobs
-        jobs = {jb.name: jb for jb in context.job_queue.jobs()}
-        events = self.connector.get_events(uid=None)
-        timezone = self.connector.settings['TIMEZONE']
-        # refresh loop
-        for ev in events:
-            if ev['notify_at'] and ev['notify_at'] > dt.datetime.now():
-                if str(ev['activity_id']) in jobs:
-                    if ev['notify_at'] != jobs[str(ev['activity_id'])].next_t.replace(tzinfo=None):
-                        print(f'change notifier job for activity {ev["activity_id"]} from {jobs[str(ev["activity_id"])].next_t} to {ev["notify_at"]}')
-                        jobs[str(ev['activity_id'])].schedule_removal()
-                        context.job_queue.run_once(self.notify, pytz.timezone(timezone).localize(ev['notify_at']), context={'activity_id': ev['activity_id']}, name=str(ev['activity_id']))
-                else:
-                    print(f'add notifier job for activity {ev["activity_id"]} at {ev["notify_at"]}')
-                    context.job_queue.run_once(self.notify, pytz.timezone(timezone).localize(ev['notify_at']), context={'activity_id': ev['activity_id']}, name=str(ev['activity_id']))
+    def __schedule_notifier(self, job_queue, ev, jobs):
+        """ Add, change or remove notifier job of activity """
+        name = str(ev['activity_id'])
+        if ev['notify_at'] and ev['notify_at'] > dt.datetime.now():
+            notify_at = self.connector.settings['TIMEZONE'].localize(ev['notify_at'])
+            if name in jobs:
+                if ev['notify_at'] != jobs[name].next_t.replace(tzinfo=None):
+                    log.info('change notifier job for activity %s from %s to %s', ev['activity_id'], jobs[name].next_t, ev['notify_at'])
+                    jobs[name].schedule_removal()
+                    job_queue.run_once(self.notify, notify_at, context={'activity_id': ev['activity_id']}, name=name)
             else:
-                if str(ev['activity_id']) in jobs:
-                    print(f'remove notifier job for activity {ev["activity_id"]}')
-                    jobs[str(ev['activity_id'])].schedule_removal()
+                log.info('add notifier job for activity %s at %s', ev['activity_id'], ev['notify_at'])
+                job_queue.run_once(self.notify, notify_at, context={'activity_id': ev['activity_id']}, name=name)
+        else:
+            if name in jobs:
+                log.info('remove notifier job for activity %s', ev['activity_id'])
+                jobs[name].schedule_removal()
+
+    def refresh_notifiers(self, context):
+        """ Refresh notifier jobs (full scan); skipped until settings are loaded: time zone must not be default """
+        if not self.connector.wait_settings(0):
+            return
+        with self.__notifiers_lock:
+            # collect jobs
+            jobs = {jb.name: jb for jb in context.job_queue.jobs() if not jb.removed}
+            events = self.connector.get_events(uid=None)
+            # refresh loop
+            for ev in events:
+                self.__schedule_notifier(context.job_queue, ev, jobs)
+
+    def reschedule_notifier(self, job_queue, activity_id):
+        """ Refresh notifier job of changed activity; skipped until settings are loaded (full scan follows loading) """
+        if not self.connector.wait_settings(0):
+            return
+        with self.__notifiers_lock:
+            jobs = {jb.name: jb for jb in job_queue.get_jobs_by_name(str(activity_id)) if not jb.removed}
+            ev = self.connector.get_events(uid=None, eid=activity_id)
+            self.__schedule_notifier(job_queue, ev or {'activity_id': activity_id, 'notify_at': None}, jobs)
@@ -0,0 +1,257 @@
+import time
+import logging
+import inspect
+import threading
+import contextvars
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from psycopg2.extras import DictCursor
+from telegram import Bot
+
+
+log = logging.getLogger(__name__)
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+
+class Counter:
+    """ Monotonic counter with labels """
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + value
+
+    def total(self):
+        """ Sum over all labels """
+        with self.__lock:
+            return sum(self.__values.values())
+
+    def render(self):
+        with self.__lock:
+            values = dict(self.__values)
+        yield f'# HELP {self.name} {self.doc}\n# TYPE {self.name} counter'
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_labels(key)} {value}'
+
+
+class Histogram:
+    """ Cumulative histogram with labels """
+    def __init__(self, name, doc, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self.__values = {}      # labels -> [bucket counts..., sum, count]
+        self.__samples = None   # labels -> raw observations, kept on demand (see `record`)
+        self.__lock = threading.Lock()
+
+    def record(self):
+        """ Start keeping raw observations for exact quantiles (benchmarks) """
+        with self.__lock:
+            self.__samples = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.__lock:
+            if (row := self.__values.get(key)) is None:
+                row = self.__values[key] = [0] * (len(self.buckets) + 2)
+            for n, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[n] += 1
+            row[-2] += value
+            row[-1] += 1
+            if self.__samples is not None:
+                self.__samples.setdefault(key, []).append(value)
+
+    def count(self):
+        """ Number of observations over all labels """
+        with self.__lock:
+            return sum(row[-1] for row in self.__values.values())
+
+    def samples(self):
+        """ Recorded observations: {labels: [values]} """
+        with self.__lock:
+            return {key: list(values) for key, values in (self.__samples or {}).items()}
+
+    def render(self):
+        with self.__lock:
+            values = {key: list(row) for key, row in self.__values.items()}
+        yield f'# HELP {self.name} {self.doc}\n# TYPE {self.name} histogram'
+        for key, row in sorted(values.items()):
+            for bound, count in zip(self.buckets, row):
+                yield f'{self.name}_bucket{_labels(key + (("le", bound), ))} {count}'
+            yield f'{self.name}_bucket{_labels(key + (("le", "+Inf"), ))} {row[-1]}'
+            yield f'{self.name}_sum{_labels(key)} {row[-2]}'
+            yield f'{self.name}_count{_labels(key)} {row[-1]}'
+
+
+class Startup:
+    """ Startup phases: seconds from `started` to the first end of each phase (logged and exported as gauge) """
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.started = time.perf_counter()
+        self.__phases = {}
+        self.__lock = threading.Lock()
+
+    def mark(self, phase):
+        """ Record the end of phase: only the first call counts """
+        if phase in self.__phases:      # cheap check for hot paths
+            return
+        with self.__lock:
+            if phase in self.__phases:
+                return
+            self.__phases[phase] = value = time.perf_counter() - self.started
+        log.info('startup: %s in %.3f s', phase, value)
+
+    def render(self):
+        with self.__lock:
+            values = dict(self.__phases)
+        yield f'# HELP {self.name} {self.doc}\n# TYPE {self.name} gauge'
+        for phase, value in values.items():
+            yield f'{self.name}{_labels((("phase", phase), ))} {value}'
+
+
+def _labels(key):
+    return '{' + ','.join(f'{k}="{v}"' for k, v in key) + '}' if key else ''
+
+
+handler_seconds = Histogram('bot_handler_seconds', 'Menu handler latency')
+handler_errors = Counter('bot_handler_errors_total', 'Menu handler exceptions')
+db_method_seconds = Histogram('bot_db_method_seconds', 'Connector method latency')
+db_method_errors = Counter('bot_db_method_errors_total', 'Connector method exceptions')
+db_query_seconds = Histogram('bot_db_query_seconds', 'Database query latency')
+update_seconds = Histogram('bot_update_seconds', 'Update processing latency')
+update_queries = Histogram('bot_update_db_queries', 'Database queries per update', COUNT_BUCKETS)
+update_errors = Counter('bot_update_errors_total', 'Update processing failures')
+telegram_seconds = Histogram('bot_telegram_request_seconds', 'Telegram Bot API request latency')
+telegram_errors = Counter('bot_telegram_errors_total', 'Telegram Bot API request failures')
+render_cache_lookups = Counter('bot_render_cache_lookups_total', 'Rendered message parts lookups')
+startup = Startup('bot_startup_seconds', 'Seconds from process start to the end of startup phase')
+METRICS = [handler_seconds, handler_errors, db_method_seconds, db_method_errors, db_query_seconds,
+           update_seconds, update_queries, update_errors, telegram_seconds, telegram_errors, render_cache_lookups, startup]
+
+
+def render():
+    """ Metrics in Prometheus text format """
+    return '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+
+
+# per-update statistics: context variable is copied to I/O threads by `iopool.gather`
+class UpdateStats:
+    __slots__ = ('queries', )
+
+    def __init__(self):
+        self.queries = 0
+
+
+_update = contextvars.ContextVar('update_stats', default=None)
+
+
+def track_update(process):
+    """ Measure update processing: latency and number of database queries """
+    @wraps(process)
+    def wrapper(*args, **kwargs):
+        stats = UpdateStats()
+        token = _update.set(stats)
+        start = time.perf_counter()
+        try:
+            return process(*args, **kwargs)
+        except Exception:
+            update_errors.inc()
+            raise
+        finally:
+            update_seconds.observe(time.perf_counter() - start)
+            update_queries.observe(stats.queries)
+            _update.reset(token)
+            startup.mark('first update')        # time to first response after deploy
+    return wrapper
+
+
+def timed(histogram, errors, **labels):
+    """ Decorator recording call latency and exceptions """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def instrument(histogram, errors, label, *, exclude=()):
+    """ Class decorator: time all public methods except `exclude` (e.g. method decorators of class body) """
+    def decorator(cls):
+        for name, method in list(vars(cls).items()):
+            if not name.startswith('_') and name not in exclude and inspect.isfunction(method):
+                setattr(cls, name, timed(histogram, errors, **{label: name})(method))
+        return cls
+    return decorator
+
+
+class InstrumentedCursor(DictCursor):
+    """ Cursor counting queries and their latency """
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - start)
+            if (stats := _update.get()) is not None:
+                stats.queries += 1
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - start)
+            if (stats := _update.get()) is not None:
+                stats.queries += 1
+
+
+class InstrumentedBot(Bot):
+    """ Bot measuring Bot API requests """
+    def _post(self, endpoint, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super()._post(endpoint, *args, **kwargs)
+        except Exception:
+            telegram_errors.inc(method=endpoint)
+            raise
+        finally:
+            telegram_seconds.observe(time.perf_counter() - start, method=endpoint)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):       # keep scrapes out of logs
+        pass
+
+
+def start_http_server(port, addr='0.0.0.0'):
+    """ Serve `/metrics` in background thread """
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
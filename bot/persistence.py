@@ -0,0 +1,146 @@
+import logging
+import time
+import pickle
+import pathlib
+import sqlite3
+import threading
+from collections import defaultdict
+from telegram.ext import BasePersistence
+
+
+log = logging.getLogger(__name__)
+
+
+class LazyUserData(defaultdict):
+    """ User data loaded from storage on first access; sessions are evicted when they become empty or end
+        (see `ShardedDispatcher.update_persistence` and `MenuHandler.direct_switch`)
+    """
+    def __init__(self, loader):
+        super().__init__(dict)
+        self.__loader = loader
+
+    def __missing__(self, user_id):
+        data = self[user_id] = self.__loader(user_id)
+        return data
+
+
+class SQLitePersistence(BasePersistence):
+    """ Conversations and user data persistence in local SQLite file
+        User data is loaded lazily on the first update of user; changes are coalesced per user
+        and written by background thread every `flush_interval` seconds, so handlers never wait for disk.
+        Session data must not contain Bot instances: it is stored as is (see `insert_bot`).
+    """
+    def __init__(self, path, *, flush_interval=2):
+        super().__init__(store_user_data=True, store_chat_data=False, store_bot_data=False)
+        self.path = path
+        self.flush_interval = flush_interval
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.__conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__conn.execute('PRAGMA journal_mode=WAL')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS conversation (name TEXT, key BLOB, state BLOB NOT NULL, PRIMARY KEY (name, key))')
+        self.__conn_lock = threading.Lock()
+        # pending writes: coalesced to the last value; None means deletion
+        self.__users = {}           # user_id -> pickled data or None
+        self.__conversations = {}   # (name, pickled key) -> pickled state or None
+        self.__pending_lock = threading.Lock()
+        self.__writer = threading.Thread(target=self.__write_loop, name='persistence', daemon=True)
+        self.__writer.start()
+
+    # Bot instances are never stored in session: skip deep copying of every object on save and load
+    def insert_bot(self, obj):
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def __load_user(self, user_id):
+        with self.__pending_lock:
+            if user_id in self.__users:         # not written yet
+                data = self.__users[user_id]
+                return pickle.loads(data) if data is not None else {}
+        with self.__conn_lock:
+            row = self.__conn.execute('SELECT data FROM user_data WHERE user_id = ?', (user_id, )).fetchone()
+        return pickle.loads(row[0]) if row else {}
+
+    def get_user_data(self):
+        return LazyUserData(self.__load_user)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_bot_data(self):
+        return {}
+
+    def get_callback_data(self):
+        return None
+
+    def get_conversations(self, name):
+        with self.__conn_lock:
+            rows = self.__conn.execute('SELECT key, state FROM conversation WHERE name = ?', (name, )).fetchall()
+        return {pickle.loads(key): pickle.loads(state) for key, state in rows}
+
+    def update_conversation(self, name, key, new_state):
+        with self.__pending_lock:
+            self.__conversations[name, pickle.dumps(key)] = pickle.dumps(new_state) if new_state is not None else None
+
+    def update_user_data(self, user_id, data):
+        # pickle right away on the handler thread: data is changed by the next update
+        data = pickle.dumps(data) if data else None
+        with self.__pending_lock:
+            self.__users[user_id] = data
+
+    def drop_user_data(self, user_id):
+        """ Forget stored user data """
+        with self.__pending_lock:
+            self.__users[user_id] = None
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+    def update_callback_data(self, data):
+        pass
+
+    def __write(self):
+        # storage is locked before taking pending changes: loader never misses data being written
+        with self.__conn_lock:
+            with self.__pending_lock:
+                users, self.__users = self.__users, {}
+                conversations, self.__conversations = self.__conversations, {}
+            if not (users or conversations):
+                return
+            try:
+                self.__commit(users, conversations)
+            except sqlite3.Error:
+                with self.__pending_lock:       # retry later, newer changes win
+                    self.__users = {**users, **self.__users}
+                    self.__conversations = {**conversations, **self.__conversations}
+                raise
+
+    def __commit(self, users, conversations):
+        with self.__conn:       # single transaction
+            self.__conn.execute('BEGIN')
+            self.__conn.executemany('INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
+                                    [(uid, data) for uid, data in users.items() if data is not None])
+            self.__conn.executemany('DELETE FROM user_data WHERE user_id = ?',
+                                    [(uid, ) for uid, data in users.items() if data is None])
+            self.__conn.executemany('INSERT OR REPLACE INTO conversation (name, key, state) VALUES (?, ?, ?)',
+                                    [(*key, state) for key, state in conversations.items() if state is not None])
+            self.__conn.executemany('DELETE FROM conversation WHERE name = ? AND key = ?',
+                                    [key for key, state in conversations.items() if state is None])
+
+    def __write_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.__write()
+            except sqlite3.Error as ex:
+                log.error('Session data is not saved: %s', ex)
+
+    def flush(self):
+        """ Write pending changes now (called by Updater on stop signal) """
+        self.__write()
@@ -0,0 +1,133 @@
+import time
+import threading
+import psycopg2
+from psycopg2 import extensions
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """ No free connection became available in time """
+
+
+class ConnectionPool:
+    """ Bounded thread-safe pool of PostgreSQL connections
+        Connections are checked on checkout: closed ones, the ones idle longer than `idle_timeout`
+        or living longer than `max_lifetime` are replaced with new ones; connections idle longer than
+        `healthcheck` seconds are pinged before being handed out.
+    """
+    def __init__(self, size=5, *, idle_timeout=300, max_lifetime=3600, healthcheck=30, wait_timeout=10, **dsn):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.healthcheck = healthcheck
+        self.wait_timeout = wait_timeout
+        self.__dsn = dsn
+        self.__idle = []        # stack of (connection, released_at)
+        self.__born = {}        # connection -> created_at
+        self.__used = 0
+        self.__cond = threading.Condition()
+
+    def __connect(self):
+        conn = psycopg2.connect(**self.__dsn)
+        conn.autocommit = True
+        return conn
+
+    def __expired(self, conn, released, now):
+        return conn.closed or (now - released > self.idle_timeout) or (now - self.__born.get(conn, now) > self.max_lifetime)
+
+    def __alive(self, conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def __discard(self, conn):
+        self.__born.pop(conn, None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """ Take connection from pool, waiting `wait_timeout` seconds at most """
+        deadline = time.monotonic() + self.wait_timeout
+        stale = []
+        try:
+            with self.__cond:
+                while True:
+                    now = time.monotonic()
+                    # the most recently released connection is the most likely to be alive
+                    while self.__idle:
+                        conn, released = self.__idle.pop()
+                        if self.__expired(conn, released, now):
+                            stale.append(conn)
+                            continue
+                        self.__used += 1
+                        break
+                    else:
+                        # no idle connections: open a new one if pool is not full or wait for release
+                        conn, released = None, now
+                        if self.__used < self.size:
+                            self.__used += 1
+                            break
+                        if now >= deadline:
+                            raise PoolTimeout(f'no free connection in {self.wait_timeout} seconds')
+                        self.__cond.wait(deadline - now)
+                        continue
+                    break
+        finally:
+            for c in stale:
+                self.__discard(c)
+        # health check & reconnect outside of the lock
+        try:
+            if conn is not None and (now - released > self.healthcheck) and not self.__alive(conn):
+                self.__discard(conn)
+                conn = None
+            if conn is None:
+                conn = self.__connect()
+                self.__born[conn] = time.monotonic()
+        except Exception:
+            with self.__cond:
+                self.__used -= 1
+                self.__cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, broken=False):
+        """ Return connection to pool """
+        if not broken and not conn.closed and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken or conn.closed:
+            self.__discard(conn)
+        with self.__cond:
+            self.__used -= 1
+            if not (broken or conn.closed):
+                self.__idle.append((conn, time.monotonic()))
+            self.__cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """ Connection context: broken connections are dropped from pool """
+        conn = self.getconn()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, broken=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        """ Close all idle connections """
+        with self.__cond:
+            idle, self.__idle = self.__idle, []
+        for conn, _ in idle:
+            self.__discard(conn)
@@ -0,0 +1,29 @@
+import threading
+from cachetools import LRUCache
+from metrics import render_cache_lookups
+
+
+_MISSING = object()
+
+
+class RenderCache:
+    """ Rendered message parts (card texts, inline keyboards) shared by all users
+        Key must contain everything the part depends on: activity row version, dialogs version, shown numbers
+        and user flags (e.g. booked or not). Parts of outdated versions are not requested anymore and are evicted as least used.
+    """
+    def __init__(self, maxsize=4096):
+        self.__cache = LRUCache(maxsize=maxsize)
+        self.__lock = threading.Lock()
+
+    def get(self, key, render):
+        """ Get cached part or render it with `render()` """
+        with self.__lock:
+            value = self.__cache.get(key, _MISSING)
+        if value is not _MISSING:
+            render_cache_lookups.inc(result='hit')
+            return value
+        render_cache_lookups.inc(result='miss')
+        value = render()
+        with self.__lock:
+            self.__cache[key] = value
+        return value
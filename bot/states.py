@@ -1,17 +1,23 @@
+import logging
 import re
-import pymorphy2
 import pathlib
 import configparser
+import time
 import random
+import threading
 from telegram.ext import ConversationHandler
-from collections import namedtuple
-from functools import partial
+from functools import partial, lru_cache
+from metrics import startup
+
+
+log = logging.getLogger(__name__)
 
 
 class CallbackData:
     """ Button callback data """
     ERROR = 'error'
     BACK = 'back'
+    PAGE = 'page'
     MAIN = 'main'
     ANNOUNCE = 'announce'
     MYBOOKING = 'mybooking'
@@ -25,6 +31,7 @@ class CallbackData:
     BOOK_CONFIRM = 'confirm_book'
     BOOK_ACCEPT = 'accept_book'
     BOOK_CONFIRM_ADMIN = 'admin_confirm_book'
+    EXPORT = 'export'
     USER_CONFIRN_NOTIFICATION = 'user_confirm_notification'
     USER_LINK = ['tg://user?id=%s', 'https://t.me/%s']
 
@@ -37,15 +44,62 @@ class ErrorState:
     SERVERSIDE = 5
 
 
-CallbackState = namedtuple('CallbackState', 'button,value', defaults=[None] * 2)   # pressed button and its additional value
+class BookState:
+    """ Booking result: BOOK_RESULT message state """
+    UNAVAILABLE = -1
+    NOPLACES = 0
+    REQUESTED = 1       # admin confirmation is required
+    FAILED = 2
+    BOOKED = 3
+    CANCELLED = 4
+
+
+class DeliveryState:
+    """ Broadcast message delivery state """
+    PENDING = 0
+    SENT = 1
+    FAILED = 2
+
+
+class CallbackState:
+    """ Pressed button and its additional value """
+    __slots__ = ('button', 'value')
+
+    def __init__(self, button=None, value=None):
+        self.button = button
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, CallbackState) and (self.button, self.value) == (other.button, other.value)
+
+    def __repr__(self):
+        return f'CallbackState(button={self.button!r}, value={self.value!r})'
+
+
+def parse_callback(data):
+    """ Split callback data `button[:value]` into (button, value) """
+    button, sep, value = data.partition(':')
+    return button, value if sep else None
 
 
 class HistoryState(list):
+    """ Menu history: the root entry is kept, the oldest steps are dropped over MAXLEN """
+    MAXLEN = 16
+
+    def __init__(self, iterable=()):
+        super().__init__(iterable)
+        del self[1:-self.MAXLEN + 1]
+
     def __getitem__(self, index=None):
         if index == None:
             index = -1
         return super().__getitem__(index)
 
+    def append(self, item):
+        super().append(item)
+        if len(self) > self.MAXLEN:
+            del self[1]
+
     @property
     def prev(self):
         return self[-2] if len(self) > 2 else CallbackState()
@@ -61,33 +115,124 @@ class ConversationState:
     MENU = 2
 
 
-class MorphString(str):
-    def __init__(self, value):
-        super().__init__()
-        self.morph = pymorphy2.MorphAnalyzer()
+_morph = None
+_morph_lock = threading.Lock()
+
+
+def morph_analyzer():
+    """ Process-wide morphological analyzer: dictionaries are loaded on first use """
+    global _morph
+    if _morph is None:
+        with _morph_lock:
+            if _morph is None:
+                import pymorphy2        # imports dictionaries: seconds of startup
+                _morph = pymorphy2.MorphAnalyzer()
+                startup.mark('morphology')
+    return _morph
+
+
+def warm_up_morph(background=True):
+    """ Load morphological dictionaries before the first agreed message is needed """
+    if background:
+        threading.Thread(target=morph_analyzer, name='morph-warm-up', daemon=True).start()
+    else:
+        morph_analyzer()
+
+
+@lru_cache(maxsize=1024)
+def agree_word(word, number):
+    """ Get word form agreed with number """
+    return morph_analyzer().parse(word)[0].make_agree_with_number(number).word
+
+
+class DialogTemplate(str):
+    """ Dialog message compiled once into literal parts, value slots and number agreement slots
+        `%s` is a value slot, `{{%s word}}` is a value slot followed by the word agreed with the value
+    """
+    TOKEN = re.compile(r'{{\s*(%s|\d+)\s+(.*?)\s*}}|%s|%%')
+    VALUE = object()        # value slot marker
+
+    def __new__(cls, value):
+        self = super().__new__(cls, value)
+        self.__parts = []
+        self.__nargs = 0
+        pos = 0
+        for token in cls.TOKEN.finditer(self):
+            self.__parts.append(self[pos:token.start()])
+            pos = token.end()
+            if token.group(0) == '%%':
+                self.__parts.append('%')
+            elif token.group(0) == '%s':
+                self.__parts.append(cls.VALUE)
+                self.__nargs += 1
+            else:
+                number = None if token.group(1) == '%s' else int(token.group(1))
+                self.__parts.append((number, token.group(2)))
+                self.__nargs += number is None
+        self.__parts.append(self[pos:])
+        self.__parts = tuple(p for p in self.__parts if p != '')
+        return self
 
     def agree_with_number(self, *values):
-        text = self % values
-        # apply morph analyzer
-        variates = re.findall(r'{{(.*?)}}', text)
-        varforms = [num + ' ' + self.morph.parse(word)[0].make_agree_with_number(int(num)).word for num, word in map(str.split, variates)]
-        return re.sub(r'{{(.*?)}}', '{}', text).format(*varforms)
+        """ Render message in one pass """
+        if len(values) != self.__nargs:
+            raise TypeError(f'message requires {self.__nargs} arguments, got {len(values)}')
+        values = iter(values)
+        rendered = []
+        for part in self.__parts:
+            if isinstance(part, str):
+                rendered.append(part)
+            elif part is self.VALUE:
+                rendered.append(str(next(values)))
+            else:
+                number = next(values) if part[0] is None else part[0]
+                rendered.append(f'{number} {agree_word(part[1], int(number))}')
+        return ''.join(rendered)
+
+    def __mod__(self, values):
+        return self.agree_with_number(*(values if isinstance(values, tuple) else (values, )))
 
 
 class DialogMessages:
-    """ Bot answers loader """
-    def __init__(self, path, sep='||'):
-        filepath = pathlib.Path(path).absolute().as_posix()
+    """ Bot answers loader
+        Messages are compiled on load; if `watch` is set, the file is checked for changes every `watch` seconds
+        and reloaded in background: lookups always use the last successfully compiled version.
+    """
+    def __init__(self, path, sep='||', *, watch=0):
+        self.path = pathlib.Path(path).absolute()
+        self.sep = sep
+        self.version = 0
+        self.__mtime = self.path.stat().st_mtime if self.path.exists() else None
+        self.__messages = self.__compile()
+        if watch:
+            threading.Thread(target=self.__watch, args=(watch, ), name='dialogs-watcher', daemon=True).start()
+
+    def __compile(self):
         dialog = configparser.ConfigParser()
-        dialog.read(filepath)
+        dialog.read(self.path.as_posix())
         # build messages dict
-        self.__messages = {section: {k: [item.strip() for item in v.split(sep)] for k, v in dialog[section].items()} for section in dialog}
+        return {section: {k: [DialogTemplate(item.strip()) for item in v.split(self.sep)] for k, v in dialog[section].items()} for section in dialog}
+
+    def __watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                mtime = self.path.stat().st_mtime
+                if mtime == self.__mtime:
+                    continue
+                messages = self.__compile()
+            except Exception as ex:
+                log.error('Dialogs reloading failed: %s', ex)
+                continue
+            self.__mtime = mtime
+            self.__messages = messages      # swap: running lookups keep the previous version
+            self.version += 1
 
     def __getitem__(self, index):
         section, key = index[:2]
-        values = self.__messages.get(section.upper(), {}).get(key.lower(), [None])
+        values = self.__messages.get(section.upper(), {}).get(key.lower(), [DialogTemplate(None)])
 
         state = index[2] if len(index) > 2 else 0
         if state == '@random':
             state = random.randint(0, len(values) - 1)
-        return MorphString(values[state])
+        return values[state]
@@ -0,0 +1,82 @@
+import hmac
+import base64
+import hashlib
+import threading
+from io import BytesIO
+from cachetools import LRUCache
+
+
+def render_ticket(link):
+    """ Render QR-code ticket as JPEG bytes """
+    import qrcode       # imported with PIL on the first ticket: slow to import, not needed to start
+    image = qrcode.make(link)
+    # convert PIL to bytes
+    bimage = BytesIO()
+    image.save(bimage, 'JPEG')
+    return bimage.getvalue()
+
+
+class TicketSigner:
+    """ Ticket deep link payload `<client_id>_<activity_id>_<signature>` signed with HMAC-SHA256 """
+    SIGNATURE_SIZE = 12     # bytes: 16 chars of payload
+
+    def __init__(self, secret):
+        self.__secret = secret.encode() if isinstance(secret, str) else secret
+
+    @classmethod
+    def from_token(cls, token):
+        """ Derive signing key from bot token """
+        return cls(hashlib.sha256(b'ticket:' + token.encode()).digest())
+
+    def __signature(self, message):
+        digest = hmac.new(self.__secret, message.encode(), hashlib.sha256).digest()[:self.SIGNATURE_SIZE]
+        return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+    def sign(self, client_id, activity_id):
+        """ Get ticket payload """
+        message = f'{int(client_id)}_{int(activity_id)}'
+        return f'{message}_{self.__signature(message)}'
+
+    def verify(self, payload):
+        """ Get (client_id, activity_id) from ticket payload or None if it is forged """
+        client_id, _, rest = payload.partition('_')
+        activity_id, _, signature = rest.partition('_')
+        if not (client_id.isdigit() and activity_id.isdigit()):
+            return None
+        if not hmac.compare_digest(signature.encode(), self.__signature(f'{client_id}_{activity_id}').encode()):
+            return None
+        return int(client_id), int(activity_id)
+
+
+class TicketCache:
+    """ Rendered ticket images (bounded by total size) and Telegram file ids of uploaded tickets """
+    def __init__(self, max_bytes=16 * 2 ** 20, max_files=10000):
+        self.__images = LRUCache(maxsize=max_bytes, getsizeof=len)
+        self.__files = LRUCache(maxsize=max_files)
+        self.__lock = threading.Lock()
+
+    def file_id(self, key):
+        """ Get file id of uploaded ticket or None """
+        with self.__lock:
+            return self.__files.get(key)
+
+    def set_file_id(self, key, file_id):
+        with self.__lock:
+            self.__files[key] = file_id
+            self.__images.pop(key, None)       # image won't be uploaded again
+
+    def image(self, key, link):
+        """ Get rendered ticket image """
+        with self.__lock:
+            image = self.__images.get(key)
+        if image is None:
+            image = render_ticket(link)
+            with self.__lock:
+                self.__images[key] = image
+        return image
+
+    def drop(self, key):
+        """ Forget ticket """
+        with self.__lock:
+            self.__images.pop(key, None)
+            self.__files.pop(key, None)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+""" Import activities and places from CSV or JSON file
+    Each record is an activity with its place: `title`, `showtime` and `place` (place title) are required;
+    optional fields are `max_visitors`, `openreg`, `notify_at`, `announce`, `info`, `active` (true by default)
+    and place fields `addr`, `place_info`, `maplink`. Timestamps are ISO formatted: `2023-02-01 19:00`.
+    Rows are validated first; valid ones are copied to a staging table and merged in one transaction:
+    activities are matched by title and showtime, places by title, so import can be safely repeated.
+    Fields of matched activities are replaced (missing ones become empty), missing place fields keep stored values.
+    Database password is taken from PGPASSWORD environment variable.
+"""
+import io
+import os
+import csv
+import sys
+import json
+import pathlib
+import argparse
+import psycopg2
+from datetime import datetime
+
+
+ACTIVITY_FIELDS = ('title', 'showtime', 'place', 'addr', 'place_info', 'maplink',
+                   'max_visitors', 'openreg', 'notify_at', 'announce', 'info', 'active')
+REQUIRED_FIELDS = ('title', 'showtime', 'place')
+TEXT_LIMITS = {'title': 200, 'place': 100, 'addr': 200, 'maplink': 2048}
+TRUE_VALUES = {'true', 't', 'yes', 'y', '1'}
+FALSE_VALUES = {'false', 'f', 'no', 'n', '0'}
+
+
+def read_records(path, fmt=None):
+    """ List of dicts from CSV (with header) or JSON (list of objects) file """
+    path = pathlib.Path(path)
+    fmt = fmt or path.suffix.lstrip('.').lower()
+    if fmt == 'json':
+        records = json.loads(path.read_text(encoding='utf-8'))
+        if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+            raise ValueError('JSON file must contain a list of objects')
+        return records
+    if fmt == 'csv':
+        with open(path, newline='', encoding='utf-8-sig') as file:      # BOM of spreadsheet editors is skipped
+            return list(csv.DictReader(file))
+    raise ValueError(f'unknown file format `{fmt}`')
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    if (value := str(value).strip().lower()) in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError(f'not a boolean: {value}')
+
+
+def validate(record):
+    """ Parse record: return (row values in ACTIVITY_FIELDS order, list of errors) """
+    # empty strings of CSV are missing values
+    record = {k.strip().lower(): v.strip() if isinstance(v, str) else v for k, v in record.items() if k is not None}
+    record = {k: v for k, v in record.items() if v not in (None, '')}
+    errors = [f'unknown field `{k}`' for k in record if k not in ACTIVITY_FIELDS]
+    errors += [f'`{k}` is required' for k in REQUIRED_FIELDS if k not in record]
+    values = dict.fromkeys(ACTIVITY_FIELDS)
+    for field, value in record.items():
+        if field not in ACTIVITY_FIELDS:
+            continue
+        try:
+            if field in ('showtime', 'openreg', 'notify_at'):
+                if not isinstance(value, str):
+                    raise ValueError(f'not a timestamp: {value}')
+                value = datetime.fromisoformat(value)
+            elif field == 'max_visitors':
+                if isinstance(value, bool) or not str(value).isdigit() or int(value) > 32767:
+                    raise ValueError(f'not a number of visitors: {value}')
+                value = int(value)
+            elif field == 'active':
+                value = parse_bool(value)
+            else:
+                value = str(value)
+                if len(value) > TEXT_LIMITS.get(field, len(value)):
+                    raise ValueError(f'longer than {TEXT_LIMITS[field]} characters')
+        except ValueError as ex:
+            errors.append(f'`{field}`: {ex}')
+            continue
+        values[field] = value
+    if values['active'] is None:
+        values['active'] = True
+    return [values[f] for f in ACTIVITY_FIELDS], errors
+
+
+def validate_all(records):
+    """ Return (valid rows with their numbers, errors as (row number, message)) """
+    rows, errors, seen = [], [], {}
+    for num, record in enumerate(records, 1):
+        if not isinstance(record, dict):
+            errors.append((num, 'record is not an object'))
+            continue
+        row, row_errors = validate(record)
+        if not row_errors and (key := (row[0], row[1])) in seen:
+            row_errors.append(f'duplicate of row {seen[key]} (same title and showtime)')
+        if row_errors:
+            errors += [(num, e) for e in row_errors]
+            continue
+        seen[row[0], row[1]] = num
+        rows.append((num, *row))
+    return rows, errors
+
+
+def load_staging(cursor, rows):
+    """ Copy rows to temporary staging table """
+    cursor.execute('''
+        CREATE TEMP TABLE content_staging (
+            row_num integer,
+            title varchar(200), showtime timestamp, place varchar(100), addr varchar(200), place_info text, maplink varchar(2048),
+            max_visitors smallint, openreg timestamp, notify_at timestamp, announce text, info text, active boolean
+        ) ON COMMIT DROP''')
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([v.isoformat(sep=' ') if isinstance(v, datetime) else v for v in row] for row in rows)
+    buffer.seek(0)
+    cursor.copy_expert(f'COPY content_staging (row_num, {", ".join(ACTIVITY_FIELDS)}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def merge(cursor, schema):
+    """ Merge staging rows into place and activity; return counts of changed rows """
+    counts = {}
+    # concurrent imports are serialized, the bot keeps reading
+    cursor.execute(f'LOCK TABLE {schema}.place, {schema}.activity IN SHARE ROW EXCLUSIVE MODE')
+    # places: the last row of place wins, missing fields keep stored values
+    cursor.execute('''
+        CREATE TEMP TABLE place_staging ON COMMIT DROP AS
+        SELECT DISTINCT ON (place) place title, addr, place_info info, maplink
+        FROM content_staging ORDER BY place, row_num DESC''')
+    cursor.execute(f'''
+        UPDATE {schema}.place p
+        SET addr = COALESCE(s.addr, p.addr), info = COALESCE(s.info, p.info), maplink = COALESCE(s.maplink, p.maplink)
+        FROM place_staging s
+        WHERE p.title = s.title
+          AND (p.addr, p.info, p.maplink) IS DISTINCT FROM (COALESCE(s.addr, p.addr), COALESCE(s.info, p.info), COALESCE(s.maplink, p.maplink))''')
+    counts['places updated'] = cursor.rowcount
+    cursor.execute(f'''
+        INSERT INTO {schema}.place (title, addr, info, maplink)
+        SELECT s.title, s.addr, s.info, s.maplink FROM place_staging s
+        WHERE NOT EXISTS (SELECT 1 FROM {schema}.place p WHERE p.title = s.title)''')
+    counts['places inserted'] = cursor.rowcount
+    # activities
+    PLACE_IDS = f'(SELECT title, MIN(place_id) place_id FROM {schema}.place GROUP BY title)'
+    cursor.execute(f'''
+        UPDATE {schema}.activity a
+        SET place = p.place_id, max_visitors = s.max_visitors, openreg = s.openreg, notify_at = s.notify_at,
+            announce = s.announce, info = s.info, active = s.active
+        FROM content_staging s JOIN {PLACE_IDS} p ON p.title = s.place
+        WHERE a.title = s.title AND a.showtime = s.showtime
+          AND (a.place, a.max_visitors, a.openreg, a.notify_at, a.announce, a.info, a.active)
+              IS DISTINCT FROM (p.place_id, s.max_visitors, s.openreg, s.notify_at, s.announce, s.info, s.active)''')
+    counts['activities updated'] = cursor.rowcount
+    cursor.execute(f'''
+        INSERT INTO {schema}.activity (title, place, max_visitors, showtime, openreg, notify_at, announce, info, active)
+        SELECT s.title, p.place_id, s.max_visitors, s.showtime, s.openreg, s.notify_at, s.announce, s.info, s.active
+        FROM content_staging s JOIN {PLACE_IDS} p ON p.title = s.place
+        WHERE NOT EXISTS (SELECT 1 FROM {schema}.activity a WHERE a.title = s.title AND a.showtime = s.showtime)
+        ORDER BY s.row_num''')
+    counts['activities inserted'] = cursor.rowcount
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', help='CSV or JSON file')
+    parser.add_argument('--format', choices=('csv', 'json'), help='file format (by extension by default)')
+    parser.add_argument('--host', default=os.environ.get('DBHOST', 'localhost'))
+    parser.add_argument('--port', default=os.environ.get('DBPORT', 5432))
+    parser.add_argument('--dbname', default=os.environ.get('DBNAME'))
+    parser.add_argument('--user', default=os.environ.get('PSQL_HANDLER_USER'), help='user with write access to content tables')
+    parser.add_argument('--schema', default=os.environ.get('SCHEMA'))
+    parser.add_argument('--skip-invalid', action='store_true', help='import valid rows even if some rows are invalid')
+    parser.add_argument('--dry-run', action='store_true', help='validate and merge, then roll back')
+    args = parser.parse_args()
+
+    try:
+        records = read_records(args.file, args.format)
+    except (OSError, ValueError) as ex:       # json.JSONDecodeError is ValueError
+        sys.exit(f'cannot read {args.file}: {ex}')
+    rows, errors = validate_all(records)
+    for num, message in errors:
+        print(f'row {num}: {message}')
+    print(f'{len(records)} rows read, {len(rows)} valid, {len({num for num, _ in errors})} invalid')
+    if errors and not args.skip_invalid:
+        sys.exit('nothing is imported: fix errors or use --skip-invalid')
+    if not rows:
+        sys.exit(0)
+
+    connection = psycopg2.connect(dbname=args.dbname, user=args.user, host=args.host, port=args.port)
+    try:
+        with connection:        # single transaction: commit on success, rollback on error
+            with connection.cursor() as cursor:
+                load_staging(cursor, rows)
+                counts = merge(cursor, args.schema)
+                if args.dry_run:
+                    connection.rollback()
+        print(('dry run: ' if args.dry_run else '') + ', '.join(f'{v} {k}' for k, v in counts.items()))
+    except psycopg2.Error as ex:
+        sys.exit(f'import failed, nothing is changed: {ex}')
+    finally:
+        connection.close()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+""" Apply pending schema migrations from `migrations` folder
+    Migration templates are rendered like `envsubst` does: `$NAME` and `${NAME}` are replaced with environment variables.
+    Database password is taken from PGPASSWORD environment variable.
+"""
+import os
+import re
+import pathlib
+import argparse
+import psycopg2
+
+
+MIGRATIONS_DIR = pathlib.Path(__file__).absolute().parent / 'migrations'
+VARIABLE = re.compile(r'\$(?:([A-Za-z_]\w*)|\{([A-Za-z_]\w*)\})')
+
+
+def render(path, env=None):
+    """ Render SQL template with environment variables (unset variables become empty) """
+    env = os.environ if env is None else env
+    return VARIABLE.sub(lambda m: env.get(m.group(1) or m.group(2), ''), pathlib.Path(path).read_text())
+
+
+def migrations(folder=MIGRATIONS_DIR):
+    """ List of (version, name, path) sorted by version """
+    found = []
+    for path in pathlib.Path(folder).glob('*.sqltemplate'):
+        version, _, name = path.stem.partition('_')
+        found.append((int(version), name, path))
+    return sorted(found)
+
+
+def applied_versions(conn, schema):
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', (f'{schema}.schema_version', ))
+        if cursor.fetchone()[0] is None:
+            return set()
+        cursor.execute(f'SELECT version FROM {schema}.schema_version')
+        return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(conn, schema, env=None, folder=MIGRATIONS_DIR, verbose=True):
+    """ Apply pending migrations, each one in its own transaction """
+    env = dict(os.environ if env is None else env, SCHEMA=schema)
+    done = applied_versions(conn, schema)
+    for version, name, path in migrations(folder):
+        if version in done:
+            continue
+        if verbose:
+            print(f'apply migration {version:04d} {name}')
+        with conn:      # commit on success, rollback on error
+            with conn.cursor() as cursor:
+                cursor.execute(render(path, env))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=os.environ.get('DBHOST', 'localhost'))
+    parser.add_argument('--port', default=os.environ.get('DBPORT', 5432))
+    parser.add_argument('--dbname', default=os.environ.get('DBNAME'))
+    parser.add_argument('--user', default=os.environ.get('PSQL_MASTER_USER'), help='schema owner')
+    parser.add_argument('--schema', default=os.environ.get('SCHEMA'))
+    parser.add_argument('--list', action='store_true', help='only show migrations state')
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(dbname=args.dbname, user=args.user, host=args.host, port=args.port)
+    if args.list:
+        applied = applied_versions(connection, args.schema)
+        for v, n, _ in migrations():
+            print(f'{v:04d} {n}: {"applied" if v in applied else "pending"}')
+    else:
+        migrate(connection, args.schema)
+    connection.close()
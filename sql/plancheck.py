@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+""" Check query plans of the bot hot queries against a generated dataset
+    Creates a scratch schema from `dump.sql`, applies migrations, fills it with generated data
+    and fails if any checked query scans a large table sequentially or misses the expected index.
+    Use a throwaway database: the scratch schema is dropped afterwards unless `--keep` is set.
+    Database password is taken from PGPASSWORD environment variable.
+"""
+import re
+import sys
+import json
+import pathlib
+import argparse
+import psycopg2
+from datetime import timedelta
+from migrate import migrate, render
+
+
+SQL_DIR = pathlib.Path(__file__).absolute().parent
+DUMP_SCHEMA = 'harpy'
+
+# hot queries of bot/bot_connector.py: keep in sync
+#   (title, query, parameters, expected indexes)
+QUERIES = [
+    ('actual events', '''
+        SELECT a.activity_id, a.title, a.showtime, a.openreg, p.title, a.max_visitors
+        FROM {schema}.activity a
+        JOIN {schema}.place p ON p.place_id = a.place
+        WHERE a.active AND (a.showtime > NOW() - %(interval)s)
+        ORDER BY a.showtime''', {'activity_actual_idx'}),
+    ('user bookings', '''
+        SELECT activity_id, quantity, redeemed
+        FROM {schema}.booking
+        WHERE client_id = %(uid)s AND activity_id = ANY(%(eids)s)''', {'booking_un'}),
+    ('activities availability', '''
+        SELECT activity_id, client_id, quantity, redeemed
+        FROM {schema}.booking
+        WHERE activity_id = ANY(%(eids)s) AND quantity > 0''', {'booking_activity_idx'}),
+    ('visitors info', '''
+        SELECT c.*, b.num_changes FROM {schema}.client c
+        JOIN {schema}.booking b on b.client_id = c.client_id
+        WHERE (b.activity_id = %(eid)s) AND (b.quantity > 0)''', {'booking_activity_idx'}),
+    ('user profile', '''
+        SELECT * FROM {schema}.client WHERE client_id = %(uid)s''', {'client_pk'}),
+]
+CHECKED_TABLES = {'activity', 'booking', 'client'}
+
+
+def load_schema(cursor, schema):
+    """ Create tables from dump in scratch schema """
+    dump = (SQL_DIR / 'dump.sql').read_text()
+    dump = '\n'.join(line for line in dump.splitlines() if not re.match(r'ALTER .* OWNER TO', line))
+    cursor.execute(re.sub(rf'\b{DUMP_SCHEMA}\b', schema, dump))
+    cursor.execute('SELECT pg_catalog.set_config(%s, %s, false)', ('search_path', 'public'))
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def check(cursor, schema, parameters):
+    """ Explain queries; return list of (title, problems, plan summary) """
+    report = []
+    for title, query, expected in QUERIES:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + query.format(schema=schema), parameters)
+        plan = cursor.fetchone()[0]
+        plan = json.loads(plan) if isinstance(plan, str) else plan
+        nodes = list(plan_nodes(plan[0]['Plan']))
+        problems = [f'sequential scan on {n["Relation Name"]}' for n in nodes
+                    if n['Node Type'] == 'Seq Scan' and n.get('Relation Name') in CHECKED_TABLES]
+        used = {n['Index Name'] for n in nodes if 'Index Name' in n}
+        problems += [f'index {idx} is not used' for idx in sorted(expected - used)]
+        summary = ', '.join(n['Node Type'] + (f' on {n["Index Name"]}' if 'Index Name' in n else f' on {n["Relation Name"]}' if 'Relation Name' in n else '')
+                            for n in nodes)
+        report.append((title, problems, summary))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=5432)
+    parser.add_argument('--dbname', required=True, help='throwaway database')
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--schema', default='plancheck', help='scratch schema name')
+    parser.add_argument('--keep', action='store_true', help='do not drop scratch schema')
+    parser.add_argument('--places', type=int, default=50)
+    parser.add_argument('--activities', type=int, default=20000)
+    parser.add_argument('--future', type=int, default=20, help='number of announced activities')
+    parser.add_argument('--clients', type=int, default=50000)
+    parser.add_argument('--visitors', type=int, default=30, help='max bookings per activity')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(dbname=args.dbname, user=args.user, host=args.host, port=args.port)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f'DROP SCHEMA IF EXISTS {args.schema} CASCADE')
+    try:
+        print(f'create scratch schema `{args.schema}`')
+        load_schema(cursor, args.schema)
+        migrate(conn, args.schema, env={'PSQL_USER': args.user, 'PSQL_HANDLER_USER': args.user})
+        print('generate dataset')
+        cursor.execute(render(SQL_DIR / 'dataset.sqltemplate', {
+            'SCHEMA': args.schema, 'PLACES': str(args.places), 'ACTIVITIES': str(args.activities),
+            'FUTURE_ACTIVITIES': str(args.future), 'CLIENTS': str(args.clients), 'VISITORS': str(args.visitors),
+        }))
+        cursor.execute(f'''SELECT array_agg(activity_id) FROM {args.schema}.activity WHERE showtime > NOW()''')
+        eids = cursor.fetchone()[0]
+        parameters = {'uid': 100000001, 'eid': eids[0], 'eids': eids, 'interval': timedelta(hours=1)}
+        failed = False
+        for title, problems, summary in check(cursor, args.schema, parameters):
+            print(f'{"FAIL" if problems else "OK"}: {title}\n    {summary}', *[f'    - {p}' for p in problems], sep='\n')
+            failed |= bool(problems)
+    finally:
+        if not args.keep:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {args.schema} CASCADE')
+        conn.close()
+    sys.exit(1 if failed else 0)
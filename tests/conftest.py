@@ -0,0 +1,5 @@
+import sys
+import pathlib
+
+# bot modules import each other as top-level ones (the bot is run from its folder)
+sys.path.insert(0, (pathlib.Path(__file__).absolute().parent.parent / 'bot').as_posix())
@@ -0,0 +1,36 @@
+import threading
+
+from availability import AvailabilityCache
+
+
+def test_reload_racing_with_write_is_not_stored():
+    cache = AvailabilityCache()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def loader(ids):
+        calls.append(ids)
+        if len(calls) == 1:         # booking state before the write
+            started.set()
+            release.wait(5)
+            return {1: ({10: 1}, set())}
+        return {1: ({10: 1, 20: 2}, set())}
+
+    reload = threading.Thread(target=cache.get, args=([1], loader))
+    reload.start()
+    started.wait(5)
+    cache.update(1, 20, 2)
+    release.set()
+    reload.join(5)
+    assert cache.get([1], loader)[1].booked == 3
+    assert len(calls) == 2
+
+
+def test_updates_are_applied_to_cached_stats():
+    cache = AvailabilityCache()
+    cache.get([1], lambda ids: {1: ({10: 1}, {10})})
+    cache.update(1, 10, 3)
+    cache.update(1, 20, 1)
+    stats = cache.get([1], lambda ids: {})[1]
+    assert stats.booked == 4
+    assert not stats.redeemed        # booking change resets ticket
@@ -0,0 +1,57 @@
+import threading
+from datetime import datetime
+
+from events import EventsCache
+
+
+NOW = datetime(2024, 1, 1, 12)
+
+
+class BlockingLoader:
+    """ Loader returning numbered results once released """
+    def __init__(self):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, window):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        return NOW, [self.calls]
+
+
+def test_concurrent_misses_wait_for_single_load():
+    cache, loader = EventsCache(), BlockingLoader()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(1, loader)[1])) for _ in range(8)]
+    for t in threads:
+        t.start()
+    loader.started.wait(5)
+    loader.release.set()
+    for t in threads:
+        t.join(5)
+    assert loader.calls == 1
+    assert results == [[1]] * 8
+
+
+def test_load_dropped_while_running_is_not_stored():
+    cache, loader = EventsCache(), BlockingLoader()
+    leader = threading.Thread(target=cache.get, args=(1, loader))
+    leader.start()
+    loader.started.wait(5)
+    cache.drop()
+    loader.release.set()
+    leader.join(5)
+    assert cache.get(1, loader)[1] == [2]
+    assert loader.calls == 2
+
+
+def test_wider_window_is_reloaded():
+    cache, loader = EventsCache(), BlockingLoader()
+    loader.release.set()
+    cache.get(1, loader)
+    cache.get(1, loader)
+    assert loader.calls == 1
+    cache.get(2, loader)
+    assert loader.calls == 2
@@ -0,0 +1,26 @@
+from persistence import SQLitePersistence
+
+
+def test_sessions_survive_restart(tmp_path):
+    path = (tmp_path / 'session.sqlite').as_posix()
+    persistence = SQLitePersistence(path, flush_interval=3600)
+    persistence.update_user_data(1, {'history': [1, 2]})
+    persistence.update_user_data(2, {'history': [3]})
+    persistence.update_conversation('menu', (1, 1), 'MAIN')
+    persistence.update_conversation('menu', (2, 2), 'MAIN')
+    persistence.flush()
+    persistence.drop_user_data(2)
+    persistence.update_conversation('menu', (2, 2), None)
+    persistence.flush()
+
+    restarted = SQLitePersistence(path, flush_interval=3600)
+    user_data = restarted.get_user_data()
+    assert user_data[1] == {'history': [1, 2]}
+    assert user_data[2] == {}
+    assert restarted.get_conversations('menu') == {(1, 1): 'MAIN'}
+
+
+def test_pending_changes_are_loaded_before_flush(tmp_path):
+    persistence = SQLitePersistence((tmp_path / 'session.sqlite').as_posix(), flush_interval=3600)
+    persistence.update_user_data(1, {'history': [1]})
+    assert persistence.get_user_data()[1] == {'history': [1]}
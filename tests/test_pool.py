@@ -0,0 +1,62 @@
+import time
+import pytest
+from psycopg2 import extensions
+
+import pool
+from pool import ConnectionPool, PoolTimeout
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """ Connections opened by pool """
+    opened = []
+    monkeypatch.setattr(pool.psycopg2, 'connect', lambda **dsn: opened.append(FakeConnection()) or opened[-1])
+    return opened
+
+
+def test_checkout_reuses_released_connection(connections):
+    cpool = ConnectionPool(2)
+    with cpool.connection() as first:
+        with cpool.connection() as second:
+            assert first is not second
+    with cpool.connection() as conn:
+        assert conn in (first, second)
+    assert len(connections) == 2
+
+
+def test_checkout_waits_for_release(connections):
+    cpool = ConnectionPool(1, wait_timeout=0.05)
+    conn = cpool.getconn()
+    with pytest.raises(PoolTimeout):
+        cpool.getconn()
+    cpool.putconn(conn)
+    assert cpool.getconn() is conn
+
+
+def test_broken_connection_is_replaced(connections):
+    cpool = ConnectionPool(1)
+    conn = cpool.getconn()
+    cpool.putconn(conn, broken=True)
+    assert conn.closed
+    assert cpool.getconn() is not conn
+
+
+@pytest.mark.parametrize('timeouts', [{'idle_timeout': 0}, {'max_lifetime': 0}])
+def test_expired_connection_is_replaced(connections, timeouts):
+    cpool = ConnectionPool(1, **timeouts)
+    conn = cpool.getconn()
+    cpool.putconn(conn)
+    time.sleep(0.01)
+    assert cpool.getconn() is not conn
+    assert conn.closed
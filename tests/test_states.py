@@ -0,0 +1,18 @@
+import pytest
+
+from states import DialogTemplate
+
+
+def test_values_are_rendered():
+    assert DialogTemplate('%s of %s, 100%%').agree_with_number(1, 2) == '1 of 2, 100%'
+
+
+@pytest.mark.parametrize('template, values', [
+    ('%s of %s', (1, )),
+    ('%s of %s', (1, 2, 3)),
+    ('{{%s place}} left', ()),
+    ('no slots', (1, )),
+])
+def test_wrong_number_of_arguments(template, values):
+    with pytest.raises(TypeError, match='arguments'):
+        DialogTemplate(template).agree_with_number(*values)